@@ -1,13 +1,37 @@
 import os
+from datetime import datetime
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import (Flask, render_template, request, flash, redirect, session,
+                   g, jsonify, abort, stream_template, get_flashed_messages,
+                   Response)
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 
+import metrics
+from counters import recount_command
+from follow_graph import (record_follow, record_follows, record_unfollow,
+                          record_user_deleted, snapshot_command)
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
+from like_buffer import init_like_buffer, pending_like_changes, toggle_like
+from migrations import add_columns_command, migrate_likes_command
 from models import db, connect_db, User, Message, Likes
+from mutuals import followers_you_follow
+from pagination import decode_cursor, encode_cursor, next_cursor
+from prewarm import init_prewarm, prewarm_home
+from recommendations import recommend_command, recommended_users
+from timeline import (init_timelines, invalidate_timeline, fan_out_message,
+                      remove_message, backfill_follow, backfill_follows,
+                      prune_follow, home_page, timeline_since, user_messages,
+                      message_key, rebuild_timelines_command)
 
 CURR_USER_KEY = "curr_user"
+PROFILE_PAGE_SIZE = 100
+FOLLOWS_PAGE_SIZE = 50
+FOLLOWS_PAGE_MAX = 200
+BULK_FOLLOW_MAX = 100
+LIKES_PAGE_SIZE = 50
+LIKES_PAGE_MAX = 200
+EPOCH_KEY = (datetime(1970, 1, 1), 0)
 
 app = Flask(__name__)
 
@@ -20,9 +44,61 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+# Authors with at least this many followers are pulled into home timelines
+# at read time instead of being pushed to every follower when they post.
+app.config['TIMELINE_CELEBRITY_THRESHOLD'] = int(
+    os.environ.get('TIMELINE_CELEBRITY_THRESHOLD', 10000))
+
+# Rendered home timeline pages kept in memory, and for how many seconds.
+app.config['TIMELINE_CACHE_SIZE'] = 10000
+app.config['TIMELINE_CACHE_TTL'] = 60
+
+# Merge home timelines in memory from per-author buffers of recent messages,
+# falling back to the timeline tables while buffers are cold. Buffers are
+# reloaded after TIMELINE_ENGINE_TTL seconds, the longest another worker
+# process can miss a post.
+app.config['TIMELINE_ENGINE_ENABLED'] = True
+app.config['TIMELINE_ENGINE_BUFFER_SIZE'] = 200
+app.config['TIMELINE_ENGINE_MAX_AUTHORS'] = 100000
+app.config['TIMELINE_ENGINE_TTL'] = 60
+
+# Warm a user's home page in the background as they log in.
+app.config['PREWARM_ON_LOGIN'] = True
+app.config['PREWARM_WORKERS'] = 2
+
+# Stream long list pages to the client as they render. Off by default:
+# the debug toolbar can't be injected into a streamed page.
+app.config['STREAM_TEMPLATES'] = (
+    os.environ.get('STREAM_TEMPLATES', 'false').lower() == 'true')
+
+# Binary snapshot of the follow graph to memory-map at startup, written by
+# `flask follow-graph-snapshot`. Unset: build the graph from the database.
+# The graph is rebuilt from the database in the background once it is
+# FOLLOW_GRAPH_TTL seconds old, picking up follows made after the snapshot
+# or in other processes (see follow_graph.py).
+app.config['FOLLOW_GRAPH_SNAPSHOT'] = os.environ.get('FOLLOW_GRAPH_SNAPSHOT')
+app.config['FOLLOW_GRAPH_TTL'] = 600
+
+# Buffer like toggles in memory and write their net effect in batches,
+# every LIKE_BUFFER_INTERVAL seconds or once LIKE_BUFFER_MAX are waiting.
+app.config['LIKE_BUFFER_ENABLED'] = (
+    os.environ.get('LIKE_BUFFER_ENABLED', 'false').lower() == 'true')
+app.config['LIKE_BUFFER_INTERVAL'] = 1.0
+app.config['LIKE_BUFFER_MAX'] = 1000
+
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+init_timelines(app)
+init_prewarm(app)
+init_like_buffer(app)
+app.cli.add_command(recount_command)
+app.cli.add_command(snapshot_command)
+app.cli.add_command(recommend_command)
+app.cli.add_command(add_columns_command)
+app.cli.add_command(migrate_likes_command)
+app.cli.add_command(rebuild_timelines_command)
 
 
 ##############################################################################
@@ -40,12 +116,122 @@ def add_user_to_g():
         g.user = None
 
 
+@app.context_processor
+def add_like_counts():
+    """Like counters as the current user should see them.
+
+    Templates call `like_count(message)` and `likes_count(user)` instead of
+    reading the stored counters, so the current user's own likes are
+    counted while the like buffer still holds them.
+    """
+
+    user = g.get('user')
+    changes = pending_like_changes(user.id) if user else {}
+
+    def like_count(message):
+        return message.like_count + changes.get(message.id, 0)
+
+    def likes_count(shown_user):
+        if user and shown_user.id == user.id:
+            return shown_user.likes_count + sum(changes.values())
+        return shown_user.likes_count
+
+    return dict(like_count=like_count, likes_count=likes_count)
+
+
 def do_login(user):
     """Log in user."""
 
     session[CURR_USER_KEY] = user.id
 
 
+def render_list_page(template, **context):
+    """Render a page whose length grows with a list of users or messages.
+
+    With STREAM_TEMPLATES on, the HTML is sent in chunks as Jinja renders
+    it, so the first byte doesn't wait for the whole list and the full
+    page is never held in memory.
+    """
+
+    if not app.config['STREAM_TEMPLATES']:
+        return render_template(template, **context)
+
+    # base.html pops flashed messages from the session; do it before the
+    # response headers (and so the session cookie) go out.
+    get_flashed_messages(with_categories=True)
+
+    return Response(stream_template(template, **context))
+
+
+def get_cursor(name='before'):
+    """Decode the pagination cursor `name` from the querystring.
+
+    Aborts with 400 if the cursor is malformed.
+    """
+
+    try:
+        return decode_cursor(request.args.get(name))
+    except ValueError:
+        abort(400)
+
+
+def get_page_size(default, cap):
+    """The `limit` querystring param, between 1 and `cap`.
+
+    Aborts with 400 if it isn't a number.
+    """
+
+    try:
+        limit = int(request.args.get('limit', default))
+    except ValueError:
+        abort(400)
+    return max(1, min(limit, cap))
+
+
+def follows_page(template, user, rows, limit):
+    """Render a page of (user, followed_at) rows as user cards."""
+
+    users = [other for other, _ in rows]
+    return render_list_page(
+        template, user=user, users=users, stats=card_stats(users),
+        limit=limit,
+        next_cursor=next_cursor(rows, limit,
+                                lambda row: (row[1], row[0].id)))
+
+
+def card_stats(users):
+    """CardStats for a page of user cards, as seen by the current user."""
+
+    return User.card_stats([user.id for user in users],
+                           g.user.id if g.user else None)
+
+
+def with_buffered_likes(user_id, messages, first_page):
+    """A page of `user_id`'s liked messages, with the likes and unlikes
+    still in the like buffer applied.
+
+    Buffered likes are the newest, so they head the first page.
+    """
+
+    changes = pending_like_changes(user_id)
+    if not changes:
+        return messages
+
+    shown = {msg.id for msg in messages}
+    liked_ids = [message_id for message_id, change in changes.items()
+                 if change > 0 and message_id not in shown]
+
+    liked = []
+    if first_page and liked_ids:
+        liked = (Message.query
+                 .options(db.joinedload(Message.user))
+                 .filter(Message.id.in_(liked_ids))
+                 .order_by(Message.timestamp.desc(), Message.id.desc())
+                 .all())
+
+    return liked + [msg for msg in messages if changes.get(msg.id, 0) >= 0]
+
+
 def do_logout():
     """Logout user."""
 
@@ -101,6 +287,7 @@ def login():
 
         if user:
             do_login(user)
+            prewarm_home(user.id)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
 
@@ -132,7 +319,8 @@ def list_users():
     else:
         users = User.query.filter(User.username.like(f"%{search}%")).all()
 
-    return render_template('users/index.html', users=users)
+    return render_list_page('users/index.html', users=users,
+                            stats=card_stats(users))
 
 
 @app.route('/users/<int:user_id>')
@@ -143,13 +331,16 @@ def users_show(user_id):
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    messages = user_messages(user_id, PROFILE_PAGE_SIZE, get_cursor())
+
+    known_followers = None
+    if g.user and g.user.id != user_id:
+        known_followers = followers_you_follow(g.user.id, user_id)
+
+    return render_list_page(
+        'users/show.html', user=user, messages=messages,
+        next_cursor=next_cursor(messages, PROFILE_PAGE_SIZE, message_key),
+        known_followers=known_followers)
 
 
 @app.route('/users/<int:user_id>/following')
@@ -161,7 +352,9 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    limit = get_page_size(FOLLOWS_PAGE_SIZE, FOLLOWS_PAGE_MAX)
+    return follows_page('users/following.html', user,
+                        user.following_page(limit, get_cursor()), limit)
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -173,7 +366,9 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    limit = get_page_size(FOLLOWS_PAGE_SIZE, FOLLOWS_PAGE_MAX)
+    return follows_page('users/followers.html', user,
+                        user.followers_page(limit, get_cursor()), limit)
 
 
 @app.route('/users/<int:user_id>/likes')
@@ -185,8 +380,18 @@ def show_user_likes(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    print(user.likes)
-    return render_template('users/likes.html', user=user)
+    limit = get_page_size(LIKES_PAGE_SIZE, LIKES_PAGE_MAX)
+    before = get_cursor()
+    rows = user.likes_page(limit, before)
+
+    messages = [msg for msg, _ in rows]
+    if user.id == g.user.id:
+        messages = with_buffered_likes(user.id, messages, not before)
+
+    return render_list_page(
+        'users/likes.html', user=user, messages=messages, limit=limit,
+        next_cursor=next_cursor(rows, limit,
+                                lambda row: (row[1], row[0].id)))
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -198,12 +403,67 @@ def add_follow(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    if g.user.follow(followed_user):
+        backfill_follow(g.user.id, followed_user.id)
+        record_follow(g.user.id, followed_user.id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
 
+def parse_user_id(value):
+    """A user id given as an int or a string of digits.
+
+    Raises ValueError for anything else, including bools and floats.
+    """
+
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.isascii() and value.isdigit():
+        return int(value)
+    raise ValueError(f"not a user id: {value!r}")
+
+
+@app.route('/users/follow', methods=['POST'])
+def bulk_follow():
+    """Follow many users at once, e.g. while onboarding.
+
+    Takes up to BULK_FOLLOW_MAX ids as a JSON body {"user_ids": [...]}
+    or as repeated `user_ids` form fields. JSON requests get back the ids
+    newly followed; form posts are redirected to the following page.
+    """
+
+    if not g.user:
+        abort(401)
+
+    if request.is_json:
+        payload = request.get_json(silent=True)
+        user_ids = None
+        if isinstance(payload, dict):
+            user_ids = payload.get('user_ids')
+    else:
+        user_ids = request.form.getlist('user_ids')
+
+    if not isinstance(user_ids, list):
+        abort(400)
+    try:
+        user_ids = {parse_user_id(user_id) for user_id in user_ids}
+    except ValueError:
+        abort(400)
+    if not user_ids or len(user_ids) > BULK_FOLLOW_MAX:
+        abort(400)
+
+    added = g.user.follow_many(list(user_ids))
+    if added:
+        backfill_follows(g.user.id, added)
+        record_follows(g.user.id, added)
+    db.session.commit()
+
+    if request.is_json:
+        return jsonify(followed=sorted(added))
+    return redirect(f"/users/{g.user.id}/following")
+
+
 @app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
@@ -212,8 +472,10 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    followed_user = User.query.get_or_404(follow_id)
+    if g.user.unfollow(followed_user):
+        prune_follow(g.user.id, followed_user.id)
+        record_unfollow(g.user.id, followed_user.id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -252,6 +514,10 @@ def delete_user():
 
     do_logout()
 
+    invalidate_timeline([follower.id for follower in g.user.followers],
+                        pulled_author_ids=[g.user.id])
+    User.discount_user(g.user.id)
+    record_user_deleted(g.user.id)
     db.session.delete(g.user)
     db.session.commit()
 
@@ -262,16 +528,14 @@ def delete_user():
 def add_remove_like(msg_id):
     """Adds/Removes a like."""
 
-    msg = Message.query.get(msg_id)
-    
-    if msg in g.user.likes:
-        like_to_delete = Likes.query.filter(Likes.user_id == g.user.id, Likes.message_id == msg_id).first()
-        db.session.delete(like_to_delete)
-        db.session.commit()
-    else:
-        new_like = Likes(user_id = g.user.id, message_id = msg_id)
-        db.session.add(new_like)
-        db.session.commit()
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    if toggle_like(g.user.id, msg_id):
+        # the like button state is part of the cached home timeline
+        invalidate_timeline([g.user.id])
+    db.session.commit()
 
     return redirect('/')
 
@@ -295,6 +559,9 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+        fan_out_message(msg)
+        User.adjust_counts(g.user.id, messages=1)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -320,6 +587,10 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    remove_message(msg)
+    User.adjust_counts(g.user.id, messages=-1)
+    User.adjust_counts(db.select(Likes.user_id)
+                       .where(Likes.message_id == msg.id), likes=-1)
     db.session.delete(msg)
     db.session.commit()
 
@@ -335,24 +606,68 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: 100 most recent messages of followed_users, older pages
+      via the `before` cursor
     """
 
     if g.user:
-        following_list = [f.id for f in g.user.following]
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_list))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        before = get_cursor()
+        messages, cursor = home_page(g.user.id, before)
+
+        # where /timeline/since polling should start from
+        since_cursor = None
+        if not before:
+            since_cursor = encode_cursor(*(message_key(messages[0])
+                                           if messages else EPOCH_KEY))
 
-        return render_template('home.html', messages=messages)
+        return render_list_page('home.html', messages=messages,
+                                next_cursor=cursor, since_cursor=since_cursor,
+                                recommended=recommended_users(g.user.id))
 
     else:
         return render_template('home-anon.html')
 
 
+@app.route('/timeline/since')
+def homepage_since():
+    """Show home timeline messages newer than the `after` cursor.
+
+    Returns JSON by default, or the timeline's HTML list items with
+    `format=html`, for clients polling for new warbles. HTML responses
+    carry the next `after` cursor and the truncated flag in the
+    X-Timeline-Cursor and X-Timeline-Truncated headers.
+    """
+
+    if not g.user:
+        abort(401)
+
+    after = get_cursor('after')
+    if not after:
+        abort(400)
+
+    messages, cursor, truncated = timeline_since(g.user.id, after)
+
+    if request.args.get('format') == 'html':
+        return Response(
+            render_template('messages/timeline-items.html',
+                            messages=messages),
+            headers={'X-Timeline-Cursor': cursor,
+                     'X-Timeline-Truncated': 'true' if truncated else 'false'})
+
+    return jsonify(
+        messages=[dict(msg._asdict(), timestamp=msg.timestamp.isoformat())
+                  for msg in messages],
+        cursor=cursor,
+        truncated=truncated)
+
+
+@app.route('/metrics')
+def show_metrics():
+    """Show in-process counters and gauges as JSON."""
+
+    return jsonify(metrics.snapshot())
+
+
 ##############################################################################
 # Turn off all caching in Flask
 #   (useful for dev; in production, this kind of stuff is typically
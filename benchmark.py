@@ -0,0 +1,252 @@
+"""Benchmark the home timeline over a synthetic follow graph.
+
+Seeds a scratch database with a generated graph, replays a fixed mix of
+home timeline requests through the app and reports latency percentiles
+and queries per request. Every table is dropped first, so seeding
+refuses to run unless the database name contains "bench", whatever
+DATABASE_URL is set to:
+
+    DATABASE_URL=postgresql:///warbler-bench python benchmark.py \\
+        --users 2000 --avg-following 80 --skew 1.2 --requests 2000
+
+Popularity follows a Zipf distribution with exponent --skew (0 gives
+every account the same chance of being followed or posting), so a few
+accounts collect most followers and messages, as on real networks.
+"""
+
+import argparse
+import os
+import random
+import re
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+os.environ.setdefault('DATABASE_URL', 'postgresql:///warbler-bench')
+
+from sqlalchemy import event
+
+import metrics
+from counters import reconcile_counts
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Follows
+from timeline import rebuild_timelines, timeline_cache, timeline_engine
+
+# bcrypt hash of "password", as in generator/users.csv
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+BATCH_SIZE = 10000
+
+# messages are spread over the two years before a fixed date, so a given
+# --random-seed always produces the same graph
+MESSAGES_END = datetime(2022, 1, 1)
+MESSAGES_SPAN = timedelta(days=730)
+
+# share of requests of each kind
+REQUEST_MIX = {
+    'home': 0.7,    # first page of the home timeline
+    'older': 0.2,   # second page, via the before= cursor
+    'since': 0.1,   # poll for new messages
+}
+
+CURSOR_PATTERNS = {
+    'older': re.compile(r'before=([\w-]+)'),
+    'since': re.compile(r'data-since="([\w-]+)"'),
+}
+CURSOR_URLS = {
+    'older': '/?before={}',
+    'since': '/timeline/since?after={}',
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--avg-following', type=int, default=50,
+                        help="mean accounts followed per user")
+    parser.add_argument('--skew', type=float, default=1.0,
+                        help="Zipf exponent of account popularity")
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--warmup', type=int, default=100,
+                        help="requests replayed before measuring")
+    parser.add_argument('--cold', action='store_true',
+                        help="clear timeline caches before every request")
+    parser.add_argument('--no-seed', action='store_true',
+                        help="reuse the graph already in the database")
+    parser.add_argument('--random-seed', type=int, default=26)
+    return parser.parse_args()
+
+
+def zipf_weights(n, skew):
+    """Cumulative weights giving rank r a chance proportional to 1 / r**skew."""
+
+    return list(accumulate(1 / rank ** skew for rank in range(1, n + 1)))
+
+
+def insert_in_batches(model, rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH_SIZE:
+            db.session.bulk_insert_mappings(model, batch)
+            batch = []
+    db.session.bulk_insert_mappings(model, batch)
+
+
+def seed_graph(args, rng):
+    """Drop all tables and load a generated graph."""
+
+    db.drop_all()
+    db.create_all()
+
+    insert_in_batches(User, (
+        dict(id=i, email=f"user{i}@bench.test", username=f"user{i}",
+             password=PASSWORD_HASH)
+        for i in range(1, args.users + 1)))
+
+    # shuffle which ids are popular so popularity isn't tied to id order
+    ranked = list(range(1, args.users + 1))
+    rng.shuffle(ranked)
+    weights = zipf_weights(args.users, args.skew)
+
+    def popular(k):
+        return rng.choices(ranked, cum_weights=weights, k=k)
+
+    insert_in_batches(Message, (
+        dict(text=f"Benchmark warble {i}", user_id=author,
+             timestamp=MESSAGES_END - rng.random() * MESSAGES_SPAN)
+        for i, author in enumerate(popular(args.messages))))
+
+    def follows():
+        for follower in range(1, args.users + 1):
+            degree = min(int(rng.expovariate(1 / args.avg_following)),
+                         args.users - 1)
+            followed = set(popular(degree)) - {follower}
+            for followed_id in followed:
+                yield dict(user_being_followed_id=followed_id,
+                           user_following_id=follower)
+
+    insert_in_batches(Follows, follows())
+    db.session.commit()
+
+    db.session.execute(db.text(
+        "SELECT setval('users_id_seq', (SELECT max(id) FROM users))"))
+    reconcile_counts()
+    rebuild_timelines()
+    db.session.commit()
+
+
+class QueryCounter:
+    """Counts SQL statements sent by the app's engine."""
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self.on_execute)
+
+    def on_execute(self, *args):
+        self.count += 1
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of already-sorted values."""
+
+    if not sorted_values:
+        return 0
+    rank = max(int(round(pct / 100 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def run_requests(client, user_ids, n, args, rng, counter, results=None):
+    """Replay `n` requests of REQUEST_MIX, recording timings in `results`."""
+
+    kinds = list(REQUEST_MIX)
+    mix = [REQUEST_MIX[kind] for kind in kinds]
+
+    for kind in rng.choices(kinds, weights=mix, k=n):
+        user_id = rng.choice(user_ids)
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        url = '/'
+        if kind != 'home':
+            # cursors come from the first page, which isn't measured
+            html = client.get('/').get_data(as_text=True)
+            match = CURSOR_PATTERNS[kind].search(html)
+            if not match:
+                continue
+            url = CURSOR_URLS[kind].format(match.group(1))
+
+        if args.cold:
+            timeline_cache.clear()
+            timeline_engine.clear()
+
+        queries = counter.count
+        start = time.perf_counter()
+        resp = client.get(url)
+        resp.get_data()
+        elapsed = time.perf_counter() - start
+
+        if results is not None:
+            results[kind].append((elapsed * 1000, counter.count - queries))
+
+
+def report(results):
+    print(f"{'request':<10}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}"
+          f"{'p99 ms':>10}{'queries':>10}")
+
+    everything = [sample for samples in results.values() for sample in samples]
+    for kind, samples in [*sorted(results.items()), ('all', everything)]:
+        latencies = sorted(ms for ms, _ in samples)
+        queries = sum(q for _, q in samples) / max(len(samples), 1)
+        print(f"{kind:<10}{len(samples):>8}"
+              f"{percentile(latencies, 50):>10.2f}"
+              f"{percentile(latencies, 95):>10.2f}"
+              f"{percentile(latencies, 99):>10.2f}"
+              f"{queries:>10.2f}")
+
+    counters = metrics.snapshot()['counters']
+    print()
+    for name in sorted(counters):
+        if name.startswith('timeline.'):
+            print(f"{name:<32}{counters[name]:>10}")
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.random_seed)
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['PREWARM_ON_LOGIN'] = False
+
+    with app.app_context():
+        if not args.no_seed:
+            # DATABASE_URL may be left set for the real database
+            database = db.engine.url.database or ''
+            if 'bench' not in database:
+                raise SystemExit(
+                    f"Refusing to drop every table in {database!r}; point "
+                    "DATABASE_URL at a database named *bench*, or pass "
+                    "--no-seed to reuse the data already there.")
+
+            started = time.perf_counter()
+            seed_graph(args, rng)
+            print(f"Seeded {args.users} users, {args.messages} messages, "
+                  f"{Follows.query.count()} follows in "
+                  f"{time.perf_counter() - started:.1f}s")
+
+        user_ids = [user_id for (user_id,) in db.session.query(User.id)]
+        counter = QueryCounter(db.engine)
+
+    client = app.test_client()
+    run_requests(client, user_ids, args.warmup, args, rng, counter)
+    metrics.reset()
+
+    results = defaultdict(list)
+    run_requests(client, user_ids, args.requests, args, rng, counter, results)
+    report(results)
+
+
+if __name__ == '__main__':
+    main()
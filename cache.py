@@ -0,0 +1,83 @@
+"""Bounded in-process caches for Warbler."""
+
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Thread-safe least-recently-used cache with a size bound and a TTL.
+
+    Entries older than `ttl` seconds are treated as missing. Hits and
+    misses are counted on the instance and reported to metrics as
+    `<name>.hits` / `<name>.misses`.
+    """
+
+    def __init__(self, maxsize, ttl, name='cache'):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Return the live value for `key`, or `default`."""
+
+        with self._lock:
+            value, expires = self._data.get(key, (_MISSING, 0))
+
+            if value is _MISSING or expires < time.monotonic():
+                self._data.pop(key, None)
+                self.misses += 1
+                metrics.incr(f'{self.name}.misses')
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            metrics.incr(f'{self.name}.hits')
+            return value
+
+    def set(self, key, value):
+        """Store `value` under `key`, evicting the oldest entries if full."""
+
+        if self.maxsize <= 0:
+            return
+
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                metrics.incr(f'{self.name}.evictions')
+
+    def pop(self, key):
+        """Drop `key` if present."""
+
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Drop every entry."""
+
+        with self._lock:
+            self._data.clear()
+
+    def resize(self, maxsize, ttl):
+        """Change the bounds, evicting down to the new size."""
+
+        with self._lock:
+            self.maxsize = maxsize
+            self.ttl = ttl
+
+            while len(self._data) > max(maxsize, 0):
+                self._data.popitem(last=False)
@@ -0,0 +1,218 @@
+"""Reconciling the stored counters.
+
+Routes adjust the users' messages_count, following_count,
+followers_count and likes_count and the messages' like_count as they
+write, but bulk loads, manual SQL or a crash between statements can
+leave them off. `reconcile_counts` and `reconcile_like_counts` recompute
+them from the rows they count, one batch of user or message ids at a
+time, and repair and report every row whose stored counts differ. Run
+them as:
+
+    flask recount [--only users|messages] [--first-id N] [--last-id N]
+                  [--batch-size N] [--dry-run]
+"""
+
+from collections import namedtuple
+
+import click
+from flask.cli import with_appcontext
+
+from models import db
+
+DEFAULT_BATCH_SIZE = 5000
+
+# largest users.id or messages.id (a Postgres integer)
+MAX_ID = 2 ** 31 - 1
+
+COUNTERS = ['messages_count', 'following_count', 'followers_count',
+            'likes_count']
+
+# A user whose stored counts differ from the rows; each field after
+# user_id is a (stored, actual) pair.
+Discrepancy = namedtuple('Discrepancy', ['user_id', *COUNTERS])
+
+# A message whose stored like_count differs, as a (stored, actual) pair.
+LikeCountDiscrepancy = namedtuple('LikeCountDiscrepancy',
+                                  ['message_id', 'like_count'])
+
+BATCH_END = """
+    SELECT max(id) FROM (
+        SELECT id FROM {table}
+        WHERE id > :after AND id <= :last
+        ORDER BY id
+        LIMIT :batch_size
+    ) AS batch
+"""
+
+USERS_BATCH_END = db.text(BATCH_END.format(table='users'))
+MESSAGES_BATCH_END = db.text(BATCH_END.format(table='messages'))
+
+ACTUAL_COUNTS = """
+    WITH actual AS (
+        SELECT u.id,
+               (SELECT count(*) FROM messages m
+                WHERE m.user_id = u.id) AS messages_count,
+               (SELECT count(*) FROM follows f
+                WHERE f.user_following_id = u.id) AS following_count,
+               (SELECT count(*) FROM follows f
+                WHERE f.user_being_followed_id = u.id) AS followers_count,
+               (SELECT count(*) FROM likes l
+                WHERE l.user_id = u.id) AS likes_count
+        FROM users u
+        WHERE u.id > :after AND u.id <= :last
+    )
+"""
+
+DIFFERS = """
+    (stored.messages_count, stored.following_count,
+     stored.followers_count, stored.likes_count)
+    IS DISTINCT FROM
+    (actual.messages_count, actual.following_count,
+     actual.followers_count, actual.likes_count)
+"""
+
+RETURNED = """
+    stored.id,
+    stored.messages_count, actual.messages_count,
+    stored.following_count, actual.following_count,
+    stored.followers_count, actual.followers_count,
+    stored.likes_count, actual.likes_count
+"""
+
+CHECK_BATCH = db.text(ACTUAL_COUNTS + f"""
+    SELECT {RETURNED}
+    FROM actual JOIN users stored ON stored.id = actual.id
+    WHERE {DIFFERS}
+    ORDER BY stored.id
+""")
+
+# `stored` is a second reference to users, so RETURNING sees the counts
+# from before the update
+REPAIR_BATCH = db.text(ACTUAL_COUNTS + f"""
+    UPDATE users
+    SET messages_count = actual.messages_count,
+        following_count = actual.following_count,
+        followers_count = actual.followers_count,
+        likes_count = actual.likes_count
+    FROM actual JOIN users stored ON stored.id = actual.id
+    WHERE users.id = actual.id AND {DIFFERS}
+    RETURNING {RETURNED}
+""")
+
+ACTUAL_LIKE_COUNTS = """
+    WITH actual AS (
+        SELECT m.id,
+               (SELECT count(*) FROM likes l
+                WHERE l.message_id = m.id) AS like_count
+        FROM messages m
+        WHERE m.id > :after AND m.id <= :last
+    )
+"""
+
+CHECK_LIKE_COUNTS = db.text(ACTUAL_LIKE_COUNTS + """
+    SELECT stored.id, stored.like_count, actual.like_count
+    FROM actual JOIN messages stored ON stored.id = actual.id
+    WHERE stored.like_count <> actual.like_count
+    ORDER BY stored.id
+""")
+
+REPAIR_LIKE_COUNTS = db.text(ACTUAL_LIKE_COUNTS + """
+    UPDATE messages
+    SET like_count = actual.like_count
+    FROM actual JOIN messages stored ON stored.id = actual.id
+    WHERE messages.id = actual.id AND stored.like_count <> actual.like_count
+    RETURNING stored.id, stored.like_count, actual.like_count
+""")
+
+
+def reconcile_counts(first_id=None, last_id=None,
+                     batch_size=DEFAULT_BATCH_SIZE, repair=True):
+    """Recompute the counters of users `first_id`..`last_id` (inclusive).
+
+    Works through the range `batch_size` users at a time, committing
+    after each batch so no lock is held for long. Returns a Discrepancy
+    for every user whose stored counts were wrong; with `repair=False`
+    nothing is written.
+    """
+
+    rows = _reconcile(USERS_BATCH_END,
+                      REPAIR_BATCH if repair else CHECK_BATCH,
+                      first_id, last_id, batch_size)
+    return [Discrepancy(row[0], *zip(row[1::2], row[2::2])) for row in rows]
+
+
+def reconcile_like_counts(first_id=None, last_id=None,
+                          batch_size=DEFAULT_BATCH_SIZE, repair=True):
+    """Recompute the like_count of messages `first_id`..`last_id`.
+
+    Batched and committed like `reconcile_counts`. Returns a
+    LikeCountDiscrepancy for every message whose count was wrong.
+    """
+
+    rows = _reconcile(MESSAGES_BATCH_END,
+                      REPAIR_LIKE_COUNTS if repair else CHECK_LIKE_COUNTS,
+                      first_id, last_id, batch_size)
+    return [LikeCountDiscrepancy(row[0], (row[1], row[2])) for row in rows]
+
+
+def _reconcile(batch_end_statement, statement, first_id, last_id,
+               batch_size):
+    after = 0 if first_id is None else first_id - 1
+    last = MAX_ID if last_id is None else last_id
+    found = []
+
+    while True:
+        batch_end = db.session.execute(
+            batch_end_statement, {'after': after, 'last': last,
+                                  'batch_size': batch_size}).scalar()
+        if batch_end is None:
+            break
+
+        found.extend(db.session.execute(statement,
+                                        {'after': after, 'last': batch_end}))
+        db.session.commit()
+        after = batch_end
+
+    return found
+
+
+@click.command('recount')
+@click.option('--only', type=click.Choice(['users', 'messages']),
+              help="Recount only user counters or only message like counts.")
+@click.option('--first-id', type=int,
+              help="Lowest user or message id to check.")
+@click.option('--last-id', type=int,
+              help="Highest user or message id to check.")
+@click.option('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+              show_default=True, help="Rows recounted per transaction.")
+@click.option('--dry-run', is_flag=True,
+              help="Report discrepancies without repairing them.")
+@with_appcontext
+def recount_command(only, first_id, last_id, batch_size, dry_run):
+    """Recompute stored counters and report any that were off."""
+
+    verb = "Found" if dry_run else "Repaired"
+
+    if only != 'messages':
+        discrepancies = reconcile_counts(first_id, last_id, batch_size,
+                                         repair=not dry_run)
+
+        for discrepancy in discrepancies:
+            changes = ', '.join(
+                f"{counter} {stored} -> {actual}"
+                for counter, (stored, actual)
+                in zip(COUNTERS, discrepancy[1:]) if stored != actual)
+            click.echo(f"user {discrepancy.user_id}: {changes}")
+
+        click.echo(f"{verb} {len(discrepancies)} users with wrong counts.")
+
+    if only != 'users':
+        discrepancies = reconcile_like_counts(first_id, last_id, batch_size,
+                                              repair=not dry_run)
+
+        for message_id, (stored, actual) in discrepancies:
+            click.echo(f"message {message_id}: "
+                       f"like_count {stored} -> {actual}")
+
+        click.echo(f"{verb} {len(discrepancies)} messages with wrong "
+                   f"like counts.")
@@ -0,0 +1,551 @@
+"""In-memory follow graph in compressed sparse row (CSR) form.
+
+Each direction of `follows` is stored as two flat arrays: `indptr`, with
+one offset per user id, and `indices`, holding every user's neighbours
+in ascending order, so user u's neighbours are
+
+    indices[indptr[u]:indptr[u + 1]]
+
+That is 4 bytes per edge per direction, and adjacency and membership
+checks need no database round trip. Follows and unfollows after the
+graph was built are kept as small per-user edit sets on top of the
+arrays and folded into fresh arrays once enough of them pile up.
+
+A graph can be written to a binary snapshot (`flask follow-graph-snapshot`)
+and memory-mapped back at startup instead of rebuilt from the database.
+Set FOLLOW_GRAPH_SNAPSHOT to load it, and leave it unset to build from
+`follows` on first use.
+
+The graph is only as fresh as what it was built from plus the follows
+committed by this process since. Follows and unfollows made after the
+snapshot was written, or made through other worker processes, are
+picked up when the graph is rebuilt from the database, which
+`loaded_follow_graph` starts in the background once it is
+FOLLOW_GRAPH_TTL seconds old. The old graph keeps serving until the new
+one is swapped in.
+"""
+
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from models import db, Follows, User
+from timeline import after_commit
+
+# edits kept on top of the arrays before they are rebuilt
+DEFAULT_COMPACT_AT = 10000
+
+SNAPSHOT_MAGIC = b'WFG1'
+# magic, padding, user id slots, edges
+SNAPSHOT_HEADER = struct.Struct('<4s4xqq')
+
+_EMPTY = array('i')
+
+
+def _zeros(typecode, n):
+    return array(typecode, bytes(n * array(typecode).itemsize))
+
+
+def _raw(ints):
+    """The bytes of an array or memoryview slice, without copying."""
+
+    return memoryview(ints).cast('B')
+
+
+class Adjacency:
+    """One direction of the graph: CSR arrays plus pending edits.
+
+    `indptr` and `indices` are arrays, or memoryviews over a snapshot.
+    `added` and `removed` map a row to the columns followed or unfollowed
+    since the arrays were built.
+    """
+
+    def __init__(self, indptr, indices):
+        self.indptr = indptr
+        self.indices = indices
+        self.added = {}
+        self.removed = {}
+        self.edits = 0
+
+    @property
+    def rows(self):
+        return len(self.indptr) - 1
+
+    def base_row(self, row):
+        if not 0 <= row < self.rows:
+            return _EMPTY
+        return self.indices[self.indptr[row]:self.indptr[row + 1]]
+
+    def row(self, row):
+        """Columns of `row`, ascending.
+
+        A row with k edits costs k bisects plus copying the base row in
+        at most k + 1 slices, however long the row is.
+        """
+
+        base = self.base_row(row)
+        added = self.added.get(row) or set()
+        removed = self.removed.get(row) or set()
+        if not added and not removed:
+            return base
+
+        # added columns are never in the base row, removed ones always are
+        merged = array('i')
+        start = 0
+        for col in sorted(added | removed):
+            i = bisect_left(base, col, start)
+            merged.frombytes(_raw(base[start:i]))
+            if col in added:
+                merged.append(col)
+                start = i
+            else:
+                start = i + 1
+        merged.frombytes(_raw(base[start:]))
+        return merged
+
+    def base_contains(self, row, col):
+        base = self.base_row(row)
+        i = bisect_left(base, col)
+        return i < len(base) and base[i] == col
+
+    def contains(self, row, col):
+        if col in self.added.get(row, ()):
+            return True
+        if col in self.removed.get(row, ()):
+            return False
+        return self.base_contains(row, col)
+
+    def add(self, row, col):
+        if col in self.removed.get(row, ()):
+            self.removed[row].discard(col)
+        elif not self.base_contains(row, col):
+            self.added.setdefault(row, set()).add(col)
+        self.edits += 1
+
+    def remove(self, row, col):
+        if col in self.added.get(row, ()):
+            self.added[row].discard(col)
+        elif self.base_contains(row, col):
+            self.removed.setdefault(row, set()).add(col)
+        self.edits += 1
+
+    def frozen(self):
+        """A copy sharing the arrays, with its own copy of the edits."""
+
+        adjacency = Adjacency(self.indptr, self.indices)
+        adjacency.added = {row: set(cols) for row, cols in self.added.items()}
+        adjacency.removed = {row: set(cols)
+                             for row, cols in self.removed.items()}
+        adjacency.edits = self.edits
+        return adjacency
+
+    def compacted(self):
+        """A new Adjacency with the edits folded into its arrays."""
+
+        rows = max([self.rows, *(row + 1 for row in self.added)])
+        indptr = _zeros('q', rows + 1)
+        indices = array('i')
+
+        for row in range(rows):
+            indices.extend(self.row(row))
+            indptr[row + 1] = len(indices)
+
+        return Adjacency(indptr, indices)
+
+
+def transpose(indptr, indices, rows):
+    """CSR arrays of the reverse graph, by counting sort."""
+
+    t_indptr = _zeros('q', rows + 1)
+    for col in indices:
+        t_indptr[col + 1] += 1
+    for row in range(rows):
+        t_indptr[row + 1] += t_indptr[row]
+
+    t_indices = _zeros('i', len(indices))
+    fill = array('q', t_indptr[:-1])
+
+    # rows are visited in order, so every reversed row comes out sorted
+    for row in range(len(indptr) - 1):
+        for k in range(indptr[row], indptr[row + 1]):
+            col = indices[k]
+            t_indices[fill[col]] = row
+            fill[col] += 1
+
+    return t_indptr, t_indices
+
+
+def intersect_sorted(a, b, limit=None):
+    """Ids in both ascending sequences `a` and `b`, ascending.
+
+    Walks the shorter sequence and bisects forward through the longer,
+    so lengths m <= n cost O(m log n). Stops after `limit` matches.
+    """
+
+    if len(a) > len(b):
+        a, b = b, a
+
+    found = []
+    lo = 0
+    for item in a:
+        lo = bisect_left(b, item, lo)
+        if lo == len(b):
+            break
+        if b[lo] == item:
+            found.append(item)
+            if limit is not None and len(found) >= limit:
+                break
+    return found
+
+
+class FollowGraph:
+    """Both directions of `follows`, indexed by user id."""
+
+    def __init__(self, following, followers,
+                 compact_at=DEFAULT_COMPACT_AT):
+        self.following = following
+        self.followers = followers
+        self.compact_at = compact_at
+        self._lock = threading.Lock()
+        # keeps a snapshot mapped for as long as the arrays point into it
+        self._mapping = None
+        # edits made while a compaction runs, replayed onto its result
+        self._journal = None
+        self._compactor = None
+
+    @classmethod
+    def from_pairs(cls, pairs, rows):
+        """Build from (follower_id, followed_id) pairs sorted by follower,
+        then followed, for user ids below `rows`."""
+
+        indptr = _zeros('q', rows + 1)
+        indices = array('i')
+
+        for follower_id, followed_id in pairs:
+            indices.append(followed_id)
+            indptr[follower_id + 1] += 1
+        for row in range(rows):
+            indptr[row + 1] += indptr[row]
+
+        return cls(Adjacency(indptr, indices),
+                   Adjacency(*transpose(indptr, indices, rows)))
+
+    @classmethod
+    def from_db(cls):
+        """Build from the `follows` table in one ordered scan."""
+
+        rows = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+        pairs = (db.session
+                 .query(Follows.user_following_id,
+                        Follows.user_being_followed_id)
+                 .order_by(Follows.user_following_id,
+                           Follows.user_being_followed_id)
+                 .yield_per(50000))
+        return cls.from_pairs(pairs, rows)
+
+    @classmethod
+    def load(cls, path):
+        """Memory-map a snapshot written by `save`.
+
+        The arrays are views into the file, so loading is instant and
+        the pages are shared by every process that maps the same file.
+        """
+
+        with open(path, 'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, rows, edges = SNAPSHOT_HEADER.unpack_from(mapping)
+        if magic != SNAPSHOT_MAGIC:
+            mapping.close()
+            raise ValueError(f"{path} is not a follow graph snapshot")
+
+        view = memoryview(mapping)
+        offset = SNAPSHOT_HEADER.size
+        arrays = []
+        for typecode, length in [('q', rows + 1), ('i', edges)] * 2:
+            size = length * array(typecode).itemsize
+            arrays.append(view[offset:offset + size].cast(typecode))
+            offset += size + (-size % 8)
+
+        graph = cls(Adjacency(*arrays[:2]), Adjacency(*arrays[2:]))
+        graph._mapping = mapping
+        return graph
+
+    def save(self, path):
+        """Write a snapshot of the graph, edits included, to `path`."""
+
+        with self._lock:
+            following = self.following.frozen()
+            followers = self.followers.frozen()
+        following = following.compacted()
+        followers = followers.compacted()
+
+        rows = max(following.rows, followers.rows)
+        tmp_path = f"{path}.tmp"
+
+        with open(tmp_path, 'wb') as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, rows,
+                                         len(following.indices)))
+            for adjacency in (following, followers):
+                indptr = array('q', adjacency.indptr)
+                # pad to the shared number of rows
+                indptr.extend([indptr[-1]] * (rows - adjacency.rows))
+                for data in (indptr, adjacency.indices):
+                    raw = data.tobytes()
+                    f.write(raw + bytes(-len(raw) % 8))
+
+        os.replace(tmp_path, path)
+
+    def following_of(self, user_id):
+        """Ids `user_id` follows, ascending."""
+
+        with self._lock:
+            return self.following.row(user_id)
+
+    def followers_of(self, user_id):
+        """Ids following `user_id`, ascending."""
+
+        with self._lock:
+            return self.followers.row(user_id)
+
+    def is_following(self, follower_id, followed_id):
+        with self._lock:
+            return self.following.contains(follower_id, followed_id)
+
+    def add_follow(self, follower_id, followed_id):
+        with self._lock:
+            self._edit(True, follower_id, followed_id)
+            self._maybe_compact()
+
+    def remove_follow(self, follower_id, followed_id):
+        with self._lock:
+            self._edit(False, follower_id, followed_id)
+            self._maybe_compact()
+
+    def remove_user(self, user_id):
+        """Drop every edge to and from `user_id`."""
+
+        with self._lock:
+            for followed_id in self.following.row(user_id):
+                self._edit(False, user_id, followed_id)
+            for follower_id in self.followers.row(user_id):
+                self._edit(False, follower_id, user_id)
+            self._maybe_compact()
+
+    def compact(self):
+        """Fold the edits into fresh arrays now.
+
+        Returns False if a compaction is already running.
+        """
+
+        with self._lock:
+            frozen = self._start_compaction()
+        if frozen is None:
+            return False
+        self._finish_compaction(*frozen)
+        return True
+
+    def _edit(self, added, follower_id, followed_id):
+        if added:
+            self.following.add(follower_id, followed_id)
+            self.followers.add(followed_id, follower_id)
+        else:
+            self.following.remove(follower_id, followed_id)
+            self.followers.remove(followed_id, follower_id)
+        if self._journal is not None:
+            self._journal.append((added, follower_id, followed_id))
+
+    def _maybe_compact(self):
+        # rebuilding the arrays takes a pass over every user, so it runs
+        # in the background while readers and writers carry on
+        if self.following.edits + self.followers.edits < self.compact_at:
+            return
+        frozen = self._start_compaction()
+        if frozen is not None:
+            self._compactor = threading.Thread(
+                target=self._finish_compaction, args=frozen,
+                name='follow-graph-compact', daemon=True)
+            self._compactor.start()
+
+    def _start_compaction(self):
+        # call with the lock held
+        if self._journal is not None:
+            return None
+        self._journal = []
+        return self.following.frozen(), self.followers.frozen()
+
+    def _finish_compaction(self, following, followers):
+        try:
+            following = following.compacted()
+            followers = followers.compacted()
+        except Exception:
+            with self._lock:
+                self._journal = None
+            raise
+
+        with self._lock:
+            journal, self._journal = self._journal, None
+            self.following, self.followers = following, followers
+            for edit in journal:
+                self._edit(*edit)
+
+
+_graph = None
+# time.monotonic() when `_graph` was loaded
+_loaded_at = None
+# follow events committed while the graph is being loaded, replayed on it
+_loading = None
+# bumped by reset_follow_graph so a load already under way is discarded
+_generation = 0
+_lock = threading.Lock()
+_load_lock = threading.Lock()
+
+
+def reset_follow_graph():
+    """Forget the loaded graph; the next `follow_graph()` loads afresh."""
+
+    global _graph, _generation
+    with _lock:
+        _graph = None
+        _generation += 1
+
+
+def follow_graph():
+    """The process-wide follow graph, loaded on first use.
+
+    Loaded from FOLLOW_GRAPH_SNAPSHOT if that file exists, otherwise
+    built from the database. Needs an app context.
+    """
+
+    if _graph is not None:
+        return _graph
+    return _load()
+
+
+def loaded_follow_graph():
+    """The follow graph if it's loaded, else None.
+
+    Never blocks: if the graph isn't loaded yet, or was loaded more than
+    FOLLOW_GRAPH_TTL seconds ago, this starts loading it in the
+    background, so callers can answer from SQL or the older graph
+    meanwhile.
+    """
+
+    if (_stale(current_app.config.get('FOLLOW_GRAPH_TTL'))
+            and not _load_lock.locked()):
+        app = current_app._get_current_object()
+        threading.Thread(target=_load_in_background, args=(app,),
+                         name='follow-graph', daemon=True).start()
+    return _graph
+
+
+def _stale(ttl):
+    return (_graph is None
+            or ttl is not None and time.monotonic() - _loaded_at >= ttl)
+
+
+def _load():
+    global _graph, _loaded_at, _loading
+
+    with _load_lock:
+        if not _stale(current_app.config.get('FOLLOW_GRAPH_TTL')):
+            return _graph
+
+        with _lock:
+            # a rebuild keeps serving and updating the old graph, and
+            # replays the same events on the new one
+            rebuild = _graph is not None
+            _loading = []
+            generation = _generation
+
+        try:
+            # a snapshot only speeds up the first load; a rebuild is
+            # for what was followed since
+            path = current_app.config.get('FOLLOW_GRAPH_SNAPSHOT')
+            if path and os.path.exists(path) and not rebuild:
+                graph = FollowGraph.load(path)
+            else:
+                graph = FollowGraph.from_db()
+        except Exception:
+            with _lock:
+                _loading = None
+            raise
+
+        with _lock:
+            for event in _loading:
+                event(graph)
+            _loading = None
+            if generation == _generation:
+                _graph = graph
+                _loaded_at = time.monotonic()
+
+    return graph
+
+
+def _load_in_background(app):
+    try:
+        with app.app_context():
+            _load()
+    except Exception:
+        app.logger.exception("Loading the follow graph failed")
+
+
+def _apply(event):
+    with _lock:
+        if _graph is not None:
+            event(_graph)
+        if _loading is not None:
+            _loading.append(event)
+
+
+def record_follow(follower_id, followed_id):
+    """Add a follow to the graph once the current transaction commits."""
+
+    after_commit(lambda: _apply(
+        lambda graph: graph.add_follow(follower_id, followed_id)))
+
+
+def record_follows(follower_id, followed_ids):
+    """`record_follow` for several users followed at once."""
+
+    def add_follows(graph):
+        for followed_id in followed_ids:
+            graph.add_follow(follower_id, followed_id)
+
+    after_commit(lambda: _apply(add_follows))
+
+
+def record_unfollow(follower_id, followed_id):
+    """Remove a follow from the graph once the current transaction commits."""
+
+    after_commit(lambda: _apply(
+        lambda graph: graph.remove_follow(follower_id, followed_id)))
+
+
+def record_user_deleted(user_id):
+    """Remove a deleted user's edges once the current transaction commits."""
+
+    after_commit(lambda: _apply(lambda graph: graph.remove_user(user_id)))
+
+
+@click.command('follow-graph-snapshot')
+@click.argument('path', required=False)
+@with_appcontext
+def snapshot_command(path):
+    """Write a snapshot of the follow graph for fast loading."""
+
+    path = path or current_app.config.get('FOLLOW_GRAPH_SNAPSHOT')
+    if not path:
+        raise click.UsageError("Give a PATH or set FOLLOW_GRAPH_SNAPSHOT.")
+
+    graph = FollowGraph.from_db()
+    graph.save(path)
+    click.echo(f"Wrote {len(graph.following.indices)} follows to {path}.")
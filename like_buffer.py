@@ -0,0 +1,238 @@
+"""Write-behind buffer for like toggles.
+
+A like button gets clicked in bursts: double clicks, like-unlike-like.
+With LIKE_BUFFER_ENABLED, toggles are recorded in memory instead of
+written one statement each. Repeated toggles of the same (user, message)
+collapse to their net effect, so a pair that ends where it started is
+never written at all, and what's left is flushed to `likes`, with the
+user and message counters, in one set-based statement every
+LIKE_BUFFER_INTERVAL seconds or once LIKE_BUFFER_MAX pairs are waiting.
+
+Until a toggle is flushed only this process knows about it. The acting
+user still sees it: their timeline (`hydrate_messages`), likes page,
+like counts on message and profile pages and their own likes count all
+add in `pending_like_changes`. Other users, and the acting user's
+requests served by other processes, see a toggle once it is flushed.
+Toggles not yet flushed are lost if the process dies without exiting
+cleanly.
+"""
+
+import atexit
+import threading
+
+from sqlalchemy.dialects.postgresql import ARRAY
+
+import metrics
+from models import db, Likes
+
+DEFAULT_INTERVAL = 1.0
+DEFAULT_MAX_PENDING = 1000
+
+# Pairs are only liked if both the user and the message still exist, and
+# each counter moves by the net change that actually reached `likes`.
+FLUSH_LIKES = db.text("""
+    WITH wanted AS (
+        SELECT * FROM unnest(:like_users, :like_messages)
+            AS w(user_id, message_id)
+    ), unwanted AS (
+        SELECT * FROM unnest(:unlike_users, :unlike_messages)
+            AS u(user_id, message_id)
+    ), added AS (
+        INSERT INTO likes (user_id, message_id)
+        SELECT w.user_id, w.message_id FROM wanted w
+        JOIN users ON users.id = w.user_id
+        JOIN messages ON messages.id = w.message_id
+        ON CONFLICT DO NOTHING
+        RETURNING user_id, message_id
+    ), removed AS (
+        DELETE FROM likes USING unwanted u
+        WHERE likes.user_id = u.user_id AND likes.message_id = u.message_id
+        RETURNING likes.user_id, likes.message_id
+    ), changes AS (
+        SELECT user_id, message_id, 1 AS delta FROM added
+        UNION ALL
+        SELECT user_id, message_id, -1 FROM removed
+    ), counted AS (
+        UPDATE users SET likes_count = likes_count + c.delta
+        FROM (SELECT user_id, sum(delta) AS delta FROM changes
+              GROUP BY user_id) AS c
+        WHERE users.id = c.user_id AND c.delta <> 0
+    ), liked AS (
+        UPDATE messages SET like_count = like_count + c.delta
+        FROM (SELECT message_id, sum(delta) AS delta FROM changes
+              GROUP BY message_id) AS c
+        WHERE messages.id = c.message_id AND c.delta <> 0
+    )
+    SELECT count(*) FROM changes
+""").bindparams(*(db.bindparam(name, type_=ARRAY(db.Integer))
+                  for name in ('like_users', 'like_messages',
+                               'unlike_users', 'unlike_messages')))
+
+
+class LikeBuffer:
+    """Pending like toggles, coalesced per (user_id, message_id)."""
+
+    def __init__(self, max_pending=DEFAULT_MAX_PENDING):
+        self.max_pending = max_pending
+        # (user_id, message_id) -> (liked when first toggled, liked now)
+        self._pending = {}
+        # the batch being written by `flush`, still visible to readers
+        self._flushing = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def toggle(self, user_id, message_id):
+        """Record a like or unlike of `message_id`; return the new state."""
+
+        key = (user_id, message_id)
+        with self._lock:
+            known = key in self._pending or key in self._flushing
+        stored = not known and db.session.get(Likes, key) is not None
+
+        with self._lock:
+            if key in self._pending:
+                was_liked, liked = self._pending[key]
+            elif key in self._flushing:
+                # what `likes` will hold once the running flush commits
+                was_liked = liked = self._flushing[key][1]
+            else:
+                was_liked = liked = stored
+
+            liked = not liked
+            if liked == was_liked:
+                del self._pending[key]
+                metrics.incr('likes.coalesced')
+            else:
+                self._pending[key] = (was_liked, liked)
+            full = len(self._pending) >= self.max_pending
+
+        metrics.incr('likes.buffered')
+        if full:
+            self._wake.set()
+        return liked
+
+    def pending_for(self, user_id):
+        """{message_id: 1 for a like, -1 for an unlike} for `user_id`'s
+        toggles not yet flushed."""
+
+        changes = {}
+        with self._lock:
+            for batch in (self._flushing, self._pending):
+                for (liker_id, message_id), states in batch.items():
+                    if liker_id == user_id:
+                        was_liked, liked = states
+                        changes[message_id] = (changes.get(message_id, 0)
+                                               + liked - was_liked)
+        return {message_id: change for message_id, change in changes.items()
+                if change}
+
+    def flush(self):
+        """Write every pending toggle in one statement and commit.
+
+        Returns the number of likes added or removed. If the write
+        fails the batch is kept for the next flush. Needs an app context.
+        """
+
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                self._flushing = batch
+            if not batch:
+                return 0
+
+            liked = [key for key, (_, now) in batch.items() if now]
+            unliked = [key for key, (_, now) in batch.items() if not now]
+            try:
+                changed = db.session.execute(FLUSH_LIKES, {
+                    'like_users': [user_id for user_id, _ in liked],
+                    'like_messages': [message_id for _, message_id in liked],
+                    'unlike_users': [user_id for user_id, _ in unliked],
+                    'unlike_messages': [message_id
+                                        for _, message_id in unliked],
+                }).scalar()
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                metrics.incr('likes.flush_failed')
+                with self._lock:
+                    self._flushing = {}
+                    self._restore(batch)
+                raise
+            with self._lock:
+                self._flushing = {}
+
+        metrics.incr('likes.flushed', changed)
+        return changed
+
+    def _restore(self, batch):
+        """Put back a batch that failed to flush, under `toggle`s made
+        since. Call with the lock held."""
+
+        for key, (was_liked, liked) in batch.items():
+            if key in self._pending:
+                # toggled again during the flush, from the batch's state
+                liked = self._pending.pop(key)[1]
+            if liked != was_liked:
+                self._pending[key] = (was_liked, liked)
+
+    def run(self, app, interval=DEFAULT_INTERVAL):
+        """Flush every `interval` seconds, or sooner once the buffer is
+        full, until the process exits."""
+
+        while True:
+            self._wake.wait(interval)
+            self._wake.clear()
+            self.flush_in(app)
+
+    def flush_in(self, app):
+        try:
+            with app.app_context():
+                self.flush()
+        except Exception:
+            app.logger.exception("Flushing buffered likes failed")
+
+
+_buffer = None
+
+
+def init_like_buffer(app):
+    """Start buffering like toggles if LIKE_BUFFER_ENABLED is set."""
+
+    global _buffer
+
+    if not app.config.get('LIKE_BUFFER_ENABLED', False):
+        _buffer = None
+        return
+
+    _buffer = LikeBuffer(
+        app.config.get('LIKE_BUFFER_MAX', DEFAULT_MAX_PENDING))
+    threading.Thread(
+        target=_buffer.run,
+        args=(app, app.config.get('LIKE_BUFFER_INTERVAL', DEFAULT_INTERVAL)),
+        name='like-buffer', daemon=True).start()
+    atexit.register(_buffer.flush_in, app)
+
+
+def toggle_like(user_id, message_id):
+    """Like or unlike `message_id` as `user_id`.
+
+    Buffered if the like buffer is running, otherwise written now as
+    part of the current transaction. Returns whether anything changed.
+    """
+
+    if _buffer is not None:
+        _buffer.toggle(user_id, message_id)
+        return True
+    return bool(Likes.toggle(user_id, message_id))
+
+
+def pending_like_changes(user_id):
+    """{message_id: 1 or -1} for `user_id`'s buffered likes and unlikes."""
+
+    if _buffer is None:
+        return {}
+    return _buffer.pending_for(user_id)
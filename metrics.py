@@ -0,0 +1,40 @@
+"""In-process counters and gauges for Warbler.
+
+Values live in this process only and are exposed as JSON at /metrics.
+"""
+
+import threading
+from collections import Counter
+
+_lock = threading.Lock()
+_counters = Counter()
+_gauges = {}
+
+
+def incr(name, amount=1):
+    """Add `amount` to the counter `name`."""
+
+    with _lock:
+        _counters[name] += amount
+
+
+def gauge(name, value):
+    """Set the gauge `name` to `value`."""
+
+    with _lock:
+        _gauges[name] = value
+
+
+def snapshot():
+    """Return a copy of all counters and gauges."""
+
+    with _lock:
+        return {'counters': dict(_counters), 'gauges': dict(_gauges)}
+
+
+def reset():
+    """Clear all counters and gauges."""
+
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
@@ -0,0 +1,305 @@
+"""Schema changes that db.create_all() can't make.
+
+create_all only creates missing tables, so changes to existing tables
+are run by hand as Flask CLI commands from here. Each checks whether it
+has already run and can be rerun safely if interrupted.
+
+    flask add-columns
+    flask migrate-likes [--batch-size N]
+
+A database that had messages before `timeline_entries` existed also
+needs `flask rebuild-timelines` once, or its home timelines are empty.
+"""
+
+import click
+from flask.cli import with_appcontext
+
+from models import db
+
+DEFAULT_BATCH_SIZE = 10000
+
+# Columns and indexes models.py has gained on tables that already existed,
+# plus the indexes they replaced. Every default is a constant or the time
+# of the ALTER, so adding a column doesn't rewrite the table.
+ADD_COLUMNS = [db.text(sql) for sql in [
+    """
+    ALTER TABLE users
+        ADD COLUMN IF NOT EXISTS messages_count integer NOT NULL DEFAULT 0,
+        ADD COLUMN IF NOT EXISTS following_count integer NOT NULL DEFAULT 0,
+        ADD COLUMN IF NOT EXISTS followers_count integer NOT NULL DEFAULT 0,
+        ADD COLUMN IF NOT EXISTS likes_count integer NOT NULL DEFAULT 0
+    """,
+    """
+    ALTER TABLE messages
+        ADD COLUMN IF NOT EXISTS fanned_out boolean NOT NULL DEFAULT true,
+        ADD COLUMN IF NOT EXISTS like_count integer NOT NULL DEFAULT 0
+    """,
+    """
+    ALTER TABLE follows
+        ADD COLUMN IF NOT EXISTS timestamp timestamp without time zone
+            NOT NULL DEFAULT timezone('utc', now())
+    """,
+    """
+    ALTER TABLE follows
+        ALTER COLUMN timestamp SET DEFAULT timezone('utc', now())
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS ix_messages_user_timestamp_id
+    ON messages (user_id, timestamp, id)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS ix_messages_pulled_user_timestamp_id
+    ON messages (user_id, timestamp, id) WHERE NOT fanned_out
+    """,
+    "DROP INDEX IF EXISTS ix_messages_pulled_user_timestamp",
+    """
+    CREATE INDEX IF NOT EXISTS ix_follows_following_timestamp
+    ON follows (user_following_id, timestamp, user_being_followed_id)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS ix_follows_followed_timestamp
+    ON follows (user_being_followed_id, timestamp, user_following_id)
+    """,
+    "DROP INDEX IF EXISTS ix_follows_user_following_id",
+]]
+
+# `likes` once it has been migrated below
+ADD_LIKES_COLUMNS = [db.text(sql) for sql in [
+    """
+    ALTER TABLE likes
+        ADD COLUMN IF NOT EXISTS timestamp timestamp without time zone
+            NOT NULL DEFAULT timezone('utc', now())
+    """,
+    # likes migrated before the default was UTC
+    """
+    ALTER TABLE likes
+        ALTER COLUMN timestamp SET DEFAULT timezone('utc', now())
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS ix_likes_user_timestamp
+    ON likes (user_id, timestamp, message_id)
+    """,
+]]
+
+# `likes` had a surrogate id and a unique message_id, allowing one like
+# per message in all. It is rebuilt as likes_new with a (user_id,
+# message_id) key, copied across in id ranges while the old table stays
+# in use, then swapped in. The old table has no liked-at time, so copied
+# likes are stamped with the time of the copy. A trigger records every
+# like inserted, updated or deleted in the old table meanwhile, whatever
+# its id (an insert can commit after its id range was copied), so the
+# swap only re-checks those pairs instead of all of likes_new.
+
+CREATE_LIKES_NEW = [db.text(sql) for sql in [
+    """
+    CREATE TABLE IF NOT EXISTS likes_new (
+        user_id integer NOT NULL,
+        message_id integer NOT NULL,
+        timestamp timestamp without time zone NOT NULL
+            DEFAULT timezone('utc', now()),
+        CONSTRAINT likes_new_pkey PRIMARY KEY (user_id, message_id),
+        CONSTRAINT likes_new_user_id_fkey FOREIGN KEY (user_id)
+            REFERENCES users (id) ON DELETE CASCADE,
+        CONSTRAINT likes_new_message_id_fkey FOREIGN KEY (message_id)
+            REFERENCES messages (id) ON DELETE CASCADE
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS likes_changed (
+        operation text NOT NULL,
+        user_id integer,
+        message_id integer
+    )
+    """,
+    # an UPDATE records the pair it left and the pair it made
+    """
+    CREATE OR REPLACE FUNCTION record_like_changed() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            INSERT INTO likes_changed (operation, user_id, message_id)
+            VALUES (TG_OP, OLD.user_id, OLD.message_id);
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO likes_changed (operation, user_id, message_id)
+            VALUES (TG_OP, NEW.user_id, NEW.message_id);
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS likes_record_changed ON likes",
+    """
+    CREATE TRIGGER likes_record_changed
+    AFTER INSERT OR UPDATE OR DELETE ON likes
+    FOR EACH ROW EXECUTE PROCEDURE record_like_changed()
+    """,
+]]
+
+COPY_LIKES = db.text("""
+    INSERT INTO likes_new (user_id, message_id)
+    SELECT user_id, message_id FROM likes
+    WHERE id > :after AND id <= :upto
+      AND user_id IS NOT NULL AND message_id IS NOT NULL
+    ON CONFLICT DO NOTHING
+""")
+
+INDEX_LIKES_NEW = [db.text(sql) for sql in [
+    """
+    CREATE INDEX IF NOT EXISTS ix_likes_new_message_id
+    ON likes_new (message_id)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS ix_likes_new_user_timestamp
+    ON likes_new (user_id, timestamp, message_id)
+    """,
+]]
+
+# run in one transaction with writes to `likes` blocked; reads go on
+SWAP_LIKES = [db.text(sql) for sql in [
+    "LOCK TABLE likes IN EXCLUSIVE MODE",
+    # likes added since the trigger was created, including any whose id
+    # range was copied before they committed
+    """
+    INSERT INTO likes_new (user_id, message_id)
+    SELECT DISTINCT c.user_id, c.message_id FROM likes_changed c
+    WHERE c.operation IN ('INSERT', 'UPDATE')
+      AND EXISTS (SELECT 1 FROM likes
+                  WHERE likes.user_id = c.user_id
+                    AND likes.message_id = c.message_id)
+    ON CONFLICT DO NOTHING
+    """,
+    # likes removed since their batch was copied, unless a duplicate of
+    # the same pair is left
+    """
+    DELETE FROM likes_new USING likes_changed c
+    WHERE c.operation IN ('UPDATE', 'DELETE')
+      AND likes_new.user_id = c.user_id
+      AND likes_new.message_id = c.message_id
+      AND NOT EXISTS (SELECT 1 FROM likes
+                      WHERE likes.user_id = c.user_id
+                        AND likes.message_id = c.message_id)
+    """,
+    "DROP TABLE likes",
+    "DROP TABLE likes_changed",
+    "DROP FUNCTION record_like_changed()",
+    "ALTER TABLE likes_new RENAME TO likes",
+    "ALTER TABLE likes RENAME CONSTRAINT likes_new_pkey TO likes_pkey",
+    """
+    ALTER TABLE likes
+    RENAME CONSTRAINT likes_new_user_id_fkey TO likes_user_id_fkey
+    """,
+    """
+    ALTER TABLE likes
+    RENAME CONSTRAINT likes_new_message_id_fkey TO likes_message_id_fkey
+    """,
+    "ALTER INDEX ix_likes_new_message_id RENAME TO ix_likes_message_id",
+    """
+    ALTER INDEX ix_likes_new_user_timestamp
+    RENAME TO ix_likes_user_timestamp
+    """,
+]]
+
+# duplicate likes collapsed, so recount the messages that had any
+RECOUNT_MESSAGE_LIKES = db.text("""
+    UPDATE messages SET like_count = liked.n
+    FROM (SELECT message_id, count(*) AS n FROM likes
+          GROUP BY message_id) AS liked
+    WHERE messages.id = liked.message_id
+      AND messages.like_count <> liked.n
+""")
+
+
+def likes_migrated():
+    """Is `likes` already keyed on (user_id, message_id)?"""
+
+    return not db.session.execute(db.text("""
+        SELECT EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = current_schema()
+              AND table_name = 'likes' AND column_name = 'id')
+    """)).scalar()
+
+
+def add_columns():
+    """Add the columns and indexes create_all can't add to existing tables.
+
+    Safe to run any number of times. New counters start at 0, so run
+    `flask recount` afterwards.
+    """
+
+    for statement in ADD_COLUMNS:
+        db.session.execute(statement)
+    if likes_migrated():
+        for statement in ADD_LIKES_COLUMNS:
+            db.session.execute(statement)
+    db.session.commit()
+
+
+def migrate_likes(batch_size=DEFAULT_BATCH_SIZE):
+    """Rebuild `likes` around a (user_id, message_id) primary key.
+
+    Copies `batch_size` ids at a time, each batch in its own transaction,
+    then catches up and swaps the tables under a short write lock.
+    Duplicate likes collapse into one and message like counts are
+    recounted; run `flask recount` afterwards for the user counters.
+    Runs `add_columns` first, so the counters it updates exist. Returns
+    False if there was nothing to do.
+    """
+
+    add_columns()
+    if likes_migrated():
+        return False
+
+    # in one transaction, so no change goes unrecorded once copying starts
+    for statement in CREATE_LIKES_NEW:
+        db.session.execute(statement)
+    db.session.commit()
+
+    last_id = db.session.execute(
+        db.text("SELECT coalesce(max(id), 0) FROM likes")).scalar()
+
+    after = 0
+    while after < last_id:
+        upto = min(after + batch_size, last_id)
+        db.session.execute(COPY_LIKES, {'after': after, 'upto': upto})
+        db.session.commit()
+        after = upto
+
+    for statement in INDEX_LIKES_NEW:
+        db.session.execute(statement)
+    db.session.commit()
+
+    for statement in SWAP_LIKES:
+        db.session.execute(statement)
+    db.session.commit()
+
+    # after the write lock is released; `flask recount` repeats it
+    db.session.execute(RECOUNT_MESSAGE_LIKES)
+    db.session.commit()
+
+    return True
+
+
+@click.command('add-columns')
+@with_appcontext
+def add_columns_command():
+    """Add new columns and indexes to existing tables."""
+
+    add_columns()
+    click.echo("Added any missing columns and indexes. "
+               "Run `flask recount` to fill in the counters and "
+               "`flask rebuild-timelines` to fill in home timelines.")
+
+
+@click.command('migrate-likes')
+@click.option('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+              show_default=True, help="Likes copied per transaction.")
+@with_appcontext
+def migrate_likes_command(batch_size):
+    """Key the likes table on (user_id, message_id)."""
+
+    if migrate_likes(batch_size):
+        click.echo("Migrated likes to a (user_id, message_id) key. "
+                   "Run `flask recount` to update user like counts.")
+    else:
+        click.echo("Likes are already keyed on (user_id, message_id).")
@@ -1,13 +1,21 @@
 """SQLAlchemy models for Warbler."""
 
+from collections import namedtuple
 from datetime import datetime
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import aliased, contains_eager, load_only
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
 
+# What a user card needs beyond the user row: the user's counts, whether
+# the viewer follows them and whether they follow the viewer.
+CardStats = namedtuple('CardStats', ['messages', 'following', 'followers',
+                                     'likes', 'followed', 'follows_viewer'])
+
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
@@ -26,26 +34,166 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=db.text("timezone('utc', now())"),
+    )
+
+    # newest-first pages of both sides of the graph
+    __table_args__ = (
+        db.Index('ix_follows_following_timestamp', 'user_following_id',
+                 'timestamp', 'user_being_followed_id'),
+        db.Index('ix_follows_followed_timestamp', 'user_being_followed_id',
+                 'timestamp', 'user_following_id'),
+    )
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
     __tablename__ = 'likes' 
 
-    id = db.Column(
+    # (user_id, message_id) is the key: one like per user per message, and
+    # a user's likes are a range scan on its prefix.
+    user_id = db.Column(
         db.Integer,
-        primary_key=True
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=db.text("timezone('utc', now())"),
+    )
+
+    __table_args__ = (
+        db.Index('ix_likes_message_id', 'message_id'),
+        # a user's likes page, newest first
+        db.Index('ix_likes_user_timestamp', 'user_id',
+                 'timestamp', 'message_id'),
+    )
+
+    @classmethod
+    def toggle(cls, user_id, message_id):
+        """Like `message_id` for `user_id`, or unlike it if already liked.
+
+        One statement deletes the like if it exists, else inserts it, and
+        moves the user's likes_count and the message's like_count to
+        match, without loading any likes.
+        Returns 1 for a new like, -1 for a removed one and 0 if the
+        message doesn't exist.
+        """
+
+        return db.session.execute(TOGGLE_LIKE, {
+            'user_id': user_id,
+            'message_id': message_id,
+        }).scalar()
+
+
+TOGGLE_LIKE = db.text("""
+    WITH removed AS (
+        DELETE FROM likes
+        WHERE user_id = :user_id AND message_id = :message_id
+        RETURNING 1
+    ), added AS (
+        INSERT INTO likes (user_id, message_id)
+        SELECT :user_id, id FROM messages
+        WHERE id = :message_id AND NOT EXISTS (SELECT 1 FROM removed)
+        ON CONFLICT DO NOTHING
+        RETURNING 1
+    ), delta AS (
+        SELECT (SELECT count(*) FROM added)
+               - (SELECT count(*) FROM removed) AS likes
+    ), counted AS (
+        UPDATE users SET likes_count = likes_count + delta.likes
+        FROM delta
+        WHERE users.id = :user_id AND delta.likes <> 0
+    ), liked AS (
+        UPDATE messages SET like_count = like_count + delta.likes
+        FROM delta
+        WHERE messages.id = :message_id AND delta.likes <> 0
     )
+    SELECT likes FROM delta
+""")
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into one follower's home timeline.
+
+    Rows are written when a message is posted (fan-out on write) and when
+    a follow starts (backfill), so the home page is a single range read
+    on (user_id, timestamp) instead of a sort over every followed user.
+    """
+
+    __tablename__ = 'timeline_entries'
 
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade')
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
     )
 
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timeline_entries_user_timestamp_message',
+                 'user_id', 'timestamp', 'message_id'),
+        db.Index('ix_timeline_entries_user_author', 'user_id', 'author_id'),
+    )
+
+
+class Recommendation(db.Model):
+    """An account suggested to a user, with its friends-of-friends score.
+
+    Precomputed in batches by `flask recommend` (see recommendations.py).
+    """
+
+    __tablename__ = 'recommendations'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    recommended_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    score = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_recommendations_user_score', 'user_id', 'score'),
     )
 
 
@@ -94,6 +242,37 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Denormalized counts for profile headers and the home page, updated
+    # in the same transaction as the rows they count (see adjust_counts).
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     messages = db.relationship('Message', cascade="all, delete", backref = "user")
 
     followers = db.relationship(
@@ -115,20 +294,255 @@ class User(db.Model):
         secondary="likes"
     )
 
+    # set of followed user ids, filled in by following_ids()
+    _following_ids = None
+
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return db.session.query(
+            Follows.query
+            .filter_by(user_being_followed_id=self.id,
+                       user_following_id=other_user.id)
+            .exists()).scalar()
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.id in self.following_ids()
+
+    def following_ids(self):
+        """Ids of the users this user follows.
+
+        Loaded with one query the first time it's asked for and kept on
+        the instance, which lives as long as the request, so any number
+        of Follow/Unfollow buttons cost a set lookup each.
+        """
+
+        if 'following' in self.__dict__:
+            return {user.id for user in self.following}
+
+        if self._following_ids is None:
+            self._following_ids = {
+                user_id for (user_id,) in db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == self.id)}
+        return self._following_ids
+
+    def following_page(self, limit, before=None):
+        """Users this user follows, most recently followed first.
+
+        Returns up to `limit` (user, followed_at) rows older than the
+        (timestamp, user id) key `before`, if given. Only the columns a
+        user card shows are loaded.
+        """
+
+        return self._follows_page(Follows.user_following_id,
+                                  Follows.user_being_followed_id,
+                                  limit, before)
+
+    def followers_page(self, limit, before=None):
+        """Users following this user, like `following_page`."""
+
+        return self._follows_page(Follows.user_being_followed_id,
+                                  Follows.user_following_id,
+                                  limit, before)
+
+    def _follows_page(self, own_column, other_column, limit, before):
+        query = (db.session
+                 .query(User, Follows.timestamp)
+                 .options(load_only(User.username, User.image_url,
+                                    User.header_image_url, User.bio))
+                 .join(Follows, other_column == User.id)
+                 .filter(own_column == self.id))
+
+        if before:
+            query = query.filter(
+                db.tuple_(Follows.timestamp, other_column) < db.tuple_(*before))
+
+        return (query
+                .order_by(Follows.timestamp.desc(), other_column.desc())
+                .limit(limit)
+                .all())
+
+    def likes_page(self, limit, before=None):
+        """Messages this user liked, most recently liked first.
+
+        Returns up to `limit` (message, liked_at) rows older than the
+        (timestamp, message id) key `before`, if given, with each
+        message's author loaded in the same query.
+        """
+
+        query = (db.session
+                 .query(Message, Likes.timestamp)
+                 .join(Likes, Likes.message_id == Message.id)
+                 .join(Message.user)
+                 .options(contains_eager(Message.user))
+                 .filter(Likes.user_id == self.id))
+
+        if before:
+            query = query.filter(
+                db.tuple_(Likes.timestamp, Likes.message_id)
+                < db.tuple_(*before))
+
+        return (query
+                .order_by(Likes.timestamp.desc(), Likes.message_id.desc())
+                .limit(limit)
+                .all())
+
+    def follow(self, other_user):
+        """Start following `other_user`, updating both users' counters.
+
+        A single INSERT that does nothing if the follow already exists;
+        the following collection is never loaded. Returns whether a
+        follow was added.
+        """
+
+        added = db.session.execute(
+            insert(Follows)
+            .values(user_being_followed_id=other_user.id,
+                    user_following_id=self.id)
+            .on_conflict_do_nothing()
+            .returning(Follows.user_following_id)).first()
+
+        if added:
+            self.adjust_counts(self.id, following=1)
+            self.adjust_counts(other_user.id, followers=1)
+            self._follows_changed(other_user)
+        return added is not None
+
+    def follow_many(self, user_ids):
+        """Follow every existing user in `user_ids`, in one INSERT.
+
+        Ids already followed, unknown ids and this user's own id are
+        skipped. Counters are updated in two statements however many
+        follows were added. Returns the ids newly followed.
+        """
+
+        candidates = (db.session
+                      .query(User.id, db.literal(self.id))
+                      .filter(User.id.in_(user_ids), User.id != self.id))
+
+        added = [followed_id for (followed_id,) in db.session.execute(
+            insert(Follows)
+            .from_select(['user_being_followed_id', 'user_following_id'],
+                         candidates)
+            .on_conflict_do_nothing()
+            .returning(Follows.user_being_followed_id))]
+
+        if added:
+            self.adjust_counts(self.id, following=len(added))
+            self.adjust_counts(added, followers=1)
+            self._follows_changed()
+        return added
+
+    def unfollow(self, other_user):
+        """Stop following `other_user`, updating both users' counters.
+
+        Returns whether there was a follow to remove.
+        """
+
+        removed = (Follows.query
+                   .filter_by(user_being_followed_id=other_user.id,
+                              user_following_id=self.id)
+                   .delete(synchronize_session=False))
+
+        if removed:
+            self.adjust_counts(self.id, following=-1)
+            self.adjust_counts(other_user.id, followers=-1)
+            self._follows_changed(other_user)
+        return removed > 0
+
+    def _follows_changed(self, other_user=None):
+        """Forget follow state loaded before a follow or unfollow."""
+
+        self._following_ids = None
+        if 'following' in self.__dict__:
+            db.session.expire(self, ['following'])
+        if other_user is not None and 'followers' in other_user.__dict__:
+            db.session.expire(other_user, ['followers'])
+
+    @classmethod
+    def card_stats(cls, user_ids, viewer_id=None):
+        """CardStats for each of `user_ids`, as seen by `viewer_id`.
+
+        One query for the whole page of cards: counts come from the
+        stored counters and follow state from two primary key joins on
+        follows. Returns {user_id: CardStats}.
+        """
+
+        viewer_follows = aliased(Follows)
+        follows_viewer = aliased(Follows)
+
+        rows = (db.session
+                .query(cls.id, cls.messages_count, cls.following_count,
+                       cls.followers_count, cls.likes_count,
+                       viewer_follows.user_following_id.isnot(None),
+                       follows_viewer.user_following_id.isnot(None))
+                .outerjoin(viewer_follows, db.and_(
+                    viewer_follows.user_being_followed_id == cls.id,
+                    viewer_follows.user_following_id == viewer_id))
+                .outerjoin(follows_viewer, db.and_(
+                    follows_viewer.user_being_followed_id == viewer_id,
+                    follows_viewer.user_following_id == cls.id))
+                .filter(cls.id.in_(user_ids)))
+
+        return {user_id: CardStats(*stats) for user_id, *stats in rows}
+
+    @classmethod
+    def adjust_counts(cls, user_ids, **deltas):
+        """Add `deltas` to the counters of `user_ids` in one UPDATE.
+
+        `user_ids` is an id, a list of ids or a select of ids; `deltas`
+        are keyed by counter, e.g. adjust_counts(user.id, likes=-1).
+        """
+
+        if isinstance(user_ids, int):
+            user_ids = [user_ids]
+
+        values = {f'{name}_count': getattr(cls, f'{name}_count') + delta
+                  for name, delta in deltas.items()}
+        (cls.query
+         .filter(cls.id.in_(user_ids))
+         .update(values, synchronize_session=False))
+
+    @classmethod
+    def discount_user(cls, user_id):
+        """Take `user_id` out of other users' and messages' counters.
+
+        Call before deleting the user: their follows, their likes and the
+        likes on their messages go with them by cascade.
+        """
+
+        cls.adjust_counts(
+            db.select(Follows.user_being_followed_id)
+            .where(Follows.user_following_id == user_id),
+            followers=-1)
+        cls.adjust_counts(
+            db.select(Follows.user_following_id)
+            .where(Follows.user_being_followed_id == user_id),
+            following=-1)
+
+        lost_likes = (db.select(Likes.user_id, db.func.count().label('n'))
+                      .join(Message, Message.id == Likes.message_id)
+                      .where(Message.user_id == user_id,
+                             Likes.user_id != user_id)
+                      .group_by(Likes.user_id)
+                      .subquery())
+        (cls.query
+         .filter(cls.id == lost_likes.c.user_id)
+         .update({cls.likes_count: cls.likes_count - lost_likes.c.n},
+                 synchronize_session=False))
+
+        (Message.query
+         .filter(Message.id.in_(db.select(Likes.message_id)
+                                .where(Likes.user_id == user_id)),
+                 Message.user_id != user_id)
+         .update({Message.like_count: Message.like_count - 1},
+                 synchronize_session=False))
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -188,7 +602,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -197,6 +611,30 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # False when the author was over the celebrity threshold at posting
+    # time: the message was not pushed to follower timelines and is
+    # pulled in when a timeline is read instead.
+    fanned_out = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=True,
+    )
+
+    # Denormalized, kept in step by Likes.toggle and User.discount_user.
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    __table_args__ = (
+        db.Index('ix_messages_user_timestamp_id', 'user_id', 'timestamp', 'id'),
+        db.Index('ix_messages_pulled_user_timestamp_id',
+                 'user_id', 'timestamp', 'id',
+                 postgresql_where=db.text('NOT fanned_out')),
+    )
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
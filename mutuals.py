@@ -0,0 +1,78 @@
+"""Follower intersections: mutual followers and followers you follow.
+
+Both are intersections of two ascending id lists from the follow graph
+(follow_graph.py), costing O(m log n) for lists of length m <= n. Until
+the graph has loaded they fall back to a single SQL join. Either way at
+most COUNT_CAP matches are collected, so a profile of a huge account
+costs no more than any other.
+"""
+
+from collections import namedtuple
+
+from sqlalchemy.orm import aliased
+
+from follow_graph import intersect_sorted, loaded_follow_graph
+from models import db, Follows, User
+
+# matches listed by name
+SHOWN = 3
+
+# matches collected at most
+COUNT_CAP = 1000
+
+# The first `shown` matching users, lowest id first, and how many match
+# in all (up to COUNT_CAP).
+Mutuals = namedtuple('Mutuals', ['users', 'count'])
+
+
+def mutual_followers(user_id, other_id, shown=SHOWN):
+    """Accounts that follow both `user_id` and `other_id`."""
+
+    graph = loaded_follow_graph()
+    if graph is not None:
+        return _mutuals(intersect_sorted(graph.followers_of(user_id),
+                                         graph.followers_of(other_id),
+                                         COUNT_CAP), shown)
+
+    first, second = aliased(Follows), aliased(Follows)
+    query = (db.session
+             .query(first.user_following_id)
+             .join(second,
+                   second.user_following_id == first.user_following_id)
+             .filter(first.user_being_followed_id == user_id,
+                     second.user_being_followed_id == other_id))
+    return _mutuals(_ids(query, first.user_following_id), shown)
+
+
+def followers_you_follow(viewer_id, user_id, shown=SHOWN):
+    """Accounts `viewer_id` follows that follow `user_id`."""
+
+    graph = loaded_follow_graph()
+    if graph is not None:
+        return _mutuals(intersect_sorted(graph.following_of(viewer_id),
+                                         graph.followers_of(user_id),
+                                         COUNT_CAP), shown)
+
+    mine, theirs = aliased(Follows), aliased(Follows)
+    query = (db.session
+             .query(mine.user_being_followed_id)
+             .join(theirs,
+                   theirs.user_following_id == mine.user_being_followed_id)
+             .filter(mine.user_following_id == viewer_id,
+                     theirs.user_being_followed_id == user_id))
+    return _mutuals(_ids(query, mine.user_being_followed_id), shown)
+
+
+def _ids(query, column):
+    return [user_id for (user_id,)
+            in query.order_by(column).limit(COUNT_CAP)]
+
+
+def _mutuals(ids, shown):
+    users = []
+    if ids:
+        users = (User.query
+                 .filter(User.id.in_(ids[:shown]))
+                 .order_by(User.id)
+                 .all())
+    return Mutuals(users, len(ids))
@@ -0,0 +1,52 @@
+"""Opaque cursors for keyset pagination.
+
+A cursor names the last row of a page by its sort key, e.g. a message's
+(timestamp, id). The next page is everything strictly before that key,
+which an index on the same columns can seek to directly however deep the
+reader has scrolled.
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as DecodeError
+from datetime import datetime
+
+
+def encode_cursor(timestamp, row_id):
+    """Return an opaque cursor for the key (`timestamp`, `row_id`)."""
+
+    raw = f"{timestamp.isoformat()}|{row_id}".encode()
+    return urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return the (timestamp, row_id) key in `cursor`, or None if no cursor.
+
+    Raises ValueError if `cursor` is malformed, including a timestamp with
+    a UTC offset: keys are naive UTC and can't be compared with it.
+    """
+
+    if not cursor:
+        return None
+
+    try:
+        raw = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        timestamp, row_id = raw.split('|')
+        timestamp = datetime.fromisoformat(timestamp)
+        if timestamp.tzinfo is not None:
+            raise ValueError("timestamp has a UTC offset")
+        return timestamp, int(row_id)
+    except (DecodeError, UnicodeDecodeError, ValueError):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+
+
+def next_cursor(rows, limit, key=None):
+    """Cursor for the page after `rows`, or None if `rows` was the last page.
+
+    `key` maps a row to its (timestamp, id) sort key; without it the rows
+    are taken to be keys already.
+    """
+
+    if len(rows) < limit:
+        return None
+    last = rows[-1] if key is None else key(rows[-1])
+    return encode_cursor(*last)
@@ -0,0 +1,64 @@
+"""Background prewarming of a user's home page.
+
+Logging in redirects straight to the home timeline, the most expensive
+page a user loads. `prewarm_home` fills the timeline cache and engine
+buffers for that user on a small worker pool, so the redirect usually
+lands on a warm cache.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+import metrics
+from timeline import home_page
+
+DEFAULT_WORKERS = 2
+
+_executor = None
+_pending = set()
+_lock = threading.Lock()
+
+
+def init_prewarm(app):
+    """Start the worker pool sized by PREWARM_WORKERS."""
+
+    global _executor
+
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+
+    _executor = ThreadPoolExecutor(
+        max_workers=app.config.get('PREWARM_WORKERS', DEFAULT_WORKERS),
+        thread_name_prefix='prewarm')
+
+
+def prewarm_home(user_id):
+    """Queue a prewarm of `user_id`'s home page, unless one is pending."""
+
+    app = current_app._get_current_object()
+    if not app.config.get('PREWARM_ON_LOGIN', True) or _executor is None:
+        return
+
+    with _lock:
+        if user_id in _pending:
+            return
+        _pending.add(user_id)
+
+    _executor.submit(_prewarm_home, app, user_id)
+    metrics.incr('prewarm.queued')
+
+
+def _prewarm_home(app, user_id):
+    try:
+        with app.app_context():
+            home_page(user_id)
+        metrics.incr('prewarm.done')
+    except Exception:
+        metrics.incr('prewarm.failed')
+        app.logger.exception("Prewarming home page of user %s failed",
+                             user_id)
+    finally:
+        with _lock:
+            _pending.discard(user_id)
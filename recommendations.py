@@ -0,0 +1,116 @@
+""""Who to follow" recommendations from friends of friends.
+
+A candidate's score for a user is how many of the accounts the user
+follows also follow the candidate, i.e. the user's row of F·F where F is
+the follow adjacency matrix. Rows are computed one at a time over the
+CSR follow graph (follow_graph.py): the following lists of everyone the
+user follows are summed into a sparse accumulator, the user and the
+accounts they already follow are dropped, and the top K are kept.
+
+Scores only move as follows change, so a batch job (`flask recommend`)
+stores them in the recommendations table and the home page reads a few
+rows from it.
+"""
+
+import heapq
+from collections import Counter
+
+import click
+from flask.cli import with_appcontext
+
+from follow_graph import FollowGraph
+from models import db, Follows, Recommendation, User
+
+DEFAULT_TOP_K = 20
+DEFAULT_BATCH_SIZE = 1000
+
+# recommendations shown on the home page
+SIDEBAR_SIZE = 5
+
+
+def friends_of_friends(graph, user_id, k=DEFAULT_TOP_K):
+    """Top `k` (candidate_id, score) pairs for `user_id`, best first.
+
+    Ties go to the lower id, so results are stable between runs.
+    """
+
+    following = graph.following_of(user_id)
+
+    scores = Counter()
+    for friend_id in following:
+        scores.update(graph.following_of(friend_id))
+
+    scores.pop(user_id, None)
+    for followed_id in following:
+        scores.pop(followed_id, None)
+
+    return heapq.nsmallest(k, scores.items(),
+                           key=lambda item: (-item[1], item[0]))
+
+
+def refresh_recommendations(k=DEFAULT_TOP_K, first_id=None, last_id=None,
+                            batch_size=DEFAULT_BATCH_SIZE):
+    """Recompute the stored top `k` of users `first_id`..`last_id`.
+
+    Builds the follow graph fresh from the database, then replaces each
+    batch of users' rows in its own transaction. Returns the number of
+    users processed.
+    """
+
+    graph = FollowGraph.from_db()
+
+    query = db.session.query(User.id).order_by(User.id)
+    if first_id is not None:
+        query = query.filter(User.id >= first_id)
+    if last_id is not None:
+        query = query.filter(User.id <= last_id)
+    user_ids = [user_id for (user_id,) in query]
+
+    for start in range(0, len(user_ids), batch_size):
+        batch = user_ids[start:start + batch_size]
+
+        (Recommendation.query
+         .filter(Recommendation.user_id.in_(batch))
+         .delete(synchronize_session=False))
+        db.session.bulk_insert_mappings(Recommendation, [
+            dict(user_id=user_id, recommended_id=candidate_id, score=score)
+            for user_id in batch
+            for candidate_id, score in friends_of_friends(graph, user_id, k)])
+        db.session.commit()
+
+    return len(user_ids)
+
+
+def recommended_users(user_id, limit=SIDEBAR_SIZE):
+    """The best stored recommendations for `user_id`.
+
+    Skips accounts followed since the batch job last ran.
+    """
+
+    followed_since = (db.exists()
+                      .where(Follows.user_following_id == user_id,
+                             Follows.user_being_followed_id
+                             == Recommendation.recommended_id))
+
+    return (User.query
+            .join(Recommendation, Recommendation.recommended_id == User.id)
+            .filter(Recommendation.user_id == user_id, ~followed_since)
+            .order_by(Recommendation.score.desc(),
+                      Recommendation.recommended_id)
+            .limit(limit)
+            .all())
+
+
+@click.command('recommend')
+@click.option('--top-k', type=int, default=DEFAULT_TOP_K, show_default=True,
+              help="Recommendations stored per user.")
+@click.option('--first-id', type=int, help="Lowest user id to refresh.")
+@click.option('--last-id', type=int, help="Highest user id to refresh.")
+@click.option('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+              show_default=True, help="Users refreshed per transaction.")
+@with_appcontext
+def recommend_command(top_k, first_id, last_id, batch_size):
+    """Precompute "who to follow" recommendations."""
+
+    users = refresh_recommendations(top_k, first_id, last_id, batch_size)
+    click.echo(f"Refreshed recommendations for {users} users.")
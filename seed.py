@@ -3,6 +3,9 @@
 from csv import DictReader
 from app import db, app
 from models import User, Message, Follows
+from counters import reconcile_counts
+from recommendations import refresh_recommendations
+from timeline import rebuild_timelines
 
 with app.app_context():
     db.drop_all()
@@ -17,4 +20,7 @@ with app.app_context():
     with open('generator/follows.csv') as follows:
         db.session.bulk_insert_mappings(Follows, DictReader(follows))
 
+    reconcile_counts()
+    rebuild_timelines()
     db.session.commit()
+    refresh_recommendations()
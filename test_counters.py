@@ -0,0 +1,118 @@
+"""Counter reconciliation tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_counters.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, Message, User, Follows, Likes
+from counters import reconcile_counts, reconcile_like_counts
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+with app.app_context():
+    db.create_all()
+
+
+class CountersTestCase(TestCase):
+    """Test recomputing the stored user counters."""
+
+    def setUp(self):
+        """Create users whose counters don't match their rows."""
+
+        with app.app_context():
+            Likes.query.delete()
+            Follows.query.delete()
+            Message.query.delete()
+            User.query.delete()
+
+            users = [User.signup(username=f"user{i}",
+                                 email=f"user{i}@test.com",
+                                 password="password",
+                                 image_url=None)
+                     for i in range(3)]
+            db.session.flush()
+            self.user_ids = [user.id for user in users]
+            first, second, third = self.user_ids
+
+            msg = Message(text="Counted", user_id=first)
+            db.session.add(msg)
+            db.session.flush()
+
+            # written behind the routes' backs, so no counter moved
+            db.session.add_all([
+                Follows(user_being_followed_id=first,
+                        user_following_id=second),
+                Follows(user_being_followed_id=first,
+                        user_following_id=third),
+                Likes(user_id=second, message_id=msg.id),
+            ])
+            db.session.commit()
+
+    def test_reconcile_repairs_and_reports(self):
+        """Are wrong counters fixed and reported, batch by batch?"""
+
+        first, _, third = self.user_ids
+
+        with app.app_context():
+            found = reconcile_counts(batch_size=2)
+
+            self.assertEqual([d.user_id for d in found], self.user_ids)
+            self.assertEqual(found[0].messages_count, (0, 1))
+            self.assertEqual(found[0].followers_count, (0, 2))
+            self.assertEqual(found[1].likes_count, (0, 1))
+
+            user = User.query.get(first)
+            self.assertEqual((user.messages_count, user.followers_count),
+                             (1, 2))
+            self.assertEqual(User.query.get(third).following_count, 1)
+
+            self.assertEqual(reconcile_counts(), [])
+
+    def test_reconcile_like_counts(self):
+        """Are wrong message like counts fixed and reported?"""
+
+        with app.app_context():
+            msg = Message.query.one()
+
+            found = reconcile_like_counts(batch_size=1, repair=False)
+            self.assertEqual([tuple(d) for d in found], [(msg.id, (0, 1))])
+            self.assertEqual(Message.query.get(msg.id).like_count, 0)
+
+            self.assertEqual(len(reconcile_like_counts(batch_size=1)), 1)
+            self.assertEqual(Message.query.get(msg.id).like_count, 1)
+            self.assertEqual(reconcile_like_counts(), [])
+
+    def test_dry_run_over_a_range(self):
+        """Does the CLI check only the given ids, and write nothing?"""
+
+        second = self.user_ids[1]
+
+        result = app.test_cli_runner().invoke(args=[
+            'recount', '--only', 'users', '--first-id', str(second),
+            '--last-id', str(second), '--dry-run'])
+
+        self.assertIn(f"user {second}: following_count 0 -> 1, "
+                      f"likes_count 0 -> 1", result.output)
+        self.assertIn("Found 1 users with wrong counts.", result.output)
+        self.assertNotIn("messages", result.output)
+
+        with app.app_context():
+            self.assertEqual(User.query.get(second).likes_count, 0)
@@ -0,0 +1,102 @@
+"""Follow graph tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_follow_graph.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from follow_graph import FollowGraph
+
+# (follower, followed), sorted by follower then followed
+PAIRS = [(1, 2), (1, 3), (2, 3), (3, 1), (4, 1), (4, 3)]
+
+
+class FollowGraphTestCase(TestCase):
+    """Test the CSR follow graph."""
+
+    def setUp(self):
+        self.graph = FollowGraph.from_pairs(PAIRS, 5)
+
+    def test_adjacency_both_ways(self):
+        """Are following and followers lists built and sorted?"""
+
+        self.assertEqual(list(self.graph.following_of(4)), [1, 3])
+        self.assertEqual(list(self.graph.followers_of(3)), [1, 2, 4])
+        self.assertEqual(list(self.graph.followers_of(4)), [])
+        self.assertEqual(list(self.graph.following_of(99)), [])
+        self.assertTrue(self.graph.is_following(2, 3))
+        self.assertFalse(self.graph.is_following(3, 2))
+
+    def test_incremental_updates(self):
+        """Do follows, unfollows and deleted users show up before and
+        after compaction?"""
+
+        self.graph.add_follow(2, 4)
+        self.graph.add_follow(7, 1)
+        self.graph.remove_follow(1, 3)
+
+        self.assertEqual(list(self.graph.following_of(2)), [3, 4])
+        self.assertEqual(list(self.graph.followers_of(1)), [3, 4, 7])
+        self.assertEqual(list(self.graph.followers_of(3)), [2, 4])
+
+        self.graph.remove_user(4)
+        self.assertEqual(list(self.graph.following_of(2)), [3])
+        self.assertEqual(list(self.graph.followers_of(1)), [3, 7])
+
+        self.graph.compact_at = 0
+        self.graph.add_follow(3, 2)
+        self.graph._compactor.join()
+        self.assertEqual(self.graph.following.edits, 0)
+        self.assertEqual(list(self.graph.followers_of(1)), [3, 7])
+        self.assertEqual(list(self.graph.following_of(3)), [1, 2])
+
+    def test_edits_during_compaction(self):
+        """Are edits made while the arrays are rebuilt kept?"""
+
+        self.graph.add_follow(2, 4)
+
+        with self.graph._lock:
+            frozen = self.graph._start_compaction()
+        self.assertFalse(self.graph.compact())
+
+        # made after the compaction took its copy of the edits
+        self.graph.add_follow(3, 2)
+        self.graph.remove_follow(1, 2)
+        self.graph._finish_compaction(*frozen)
+
+        self.assertEqual(self.graph.following.edits, 2)
+        self.assertEqual(list(self.graph.following_of(2)), [3, 4])
+        self.assertEqual(list(self.graph.following_of(3)), [1, 2])
+        self.assertEqual(list(self.graph.followers_of(2)), [3])
+
+        self.assertTrue(self.graph.compact())
+        self.assertEqual(self.graph.following.edits, 0)
+        self.assertEqual(list(self.graph.following_of(1)), [3])
+
+    def test_snapshot_round_trip(self):
+        """Does a memory-mapped snapshot match the graph it was saved from?"""
+
+        self.graph.add_follow(5, 2)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'follows.bin')
+            self.graph.save(path)
+            loaded = FollowGraph.load(path)
+
+            for user_id in range(7):
+                self.assertEqual(list(loaded.following_of(user_id)),
+                                 list(self.graph.following_of(user_id)))
+                self.assertEqual(list(loaded.followers_of(user_id)),
+                                 list(self.graph.followers_of(user_id)))
+
+            loaded.remove_follow(5, 2)
+            self.assertFalse(loaded.is_following(5, 2))
+            loaded.add_follow(4, 0)
+            loaded.add_follow(4, 2)
+            loaded.remove_follow(4, 3)
+            self.assertEqual(list(loaded.following_of(4)), [0, 1, 2])
+            del loaded
@@ -0,0 +1,176 @@
+"""Like buffer tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_like_buffer.py
+
+
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+import like_buffer
+from like_buffer import LikeBuffer
+from models import db, Message, User, Follows, Likes
+from timeline import hydrate_messages
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+with app.app_context():
+    db.create_all()
+
+
+class LikeBufferTestCase(TestCase):
+    """Test buffering and flushing like toggles."""
+
+    def setUp(self):
+        """Create a liker and two messages, one already liked."""
+
+        with app.app_context():
+            Likes.query.delete()
+            Follows.query.delete()
+            Message.query.delete()
+            User.query.delete()
+
+            user = User.signup(username="liker", email="liker@test.com",
+                               password="password", image_url=None)
+            first = Message(text="First", user=user)
+            second = Message(text="Second", user=user)
+            db.session.add_all([first, second])
+            db.session.flush()
+
+            db.session.add(Likes(user_id=user.id, message_id=second.id))
+            user.likes_count = 1
+            second.like_count = 1
+            db.session.commit()
+
+            self.user_id = user.id
+            self.message_ids = [first.id, second.id]
+
+        self.buffer = LikeBuffer()
+
+    def tearDown(self):
+        like_buffer._buffer = None
+
+    def test_toggles_coalesce(self):
+        """Do repeated toggles collapse to their net effect in one flush?"""
+
+        first, second = self.message_ids
+
+        with app.app_context():
+            for _ in range(3):
+                self.buffer.toggle(self.user_id, first)
+            # liked, then unliked again: nothing to write
+            self.assertFalse(self.buffer.toggle(self.user_id, second))
+            self.assertTrue(self.buffer.toggle(self.user_id, second))
+
+            self.assertEqual(len(self.buffer), 1)
+            self.assertEqual(Likes.query.count(), 1)
+
+            self.assertEqual(self.buffer.flush(), 1)
+            self.assertEqual(len(self.buffer), 0)
+
+            self.assertEqual({like.message_id for like in Likes.query},
+                             {first, second})
+            self.assertEqual(User.query.get(self.user_id).likes_count, 2)
+            self.assertEqual(Message.query.get(first).like_count, 1)
+            self.assertEqual(Message.query.get(second).like_count, 1)
+
+    def test_flush_skips_deleted_messages(self):
+        """Are unlikes applied and likes of deleted messages dropped?"""
+
+        first, second = self.message_ids
+
+        with app.app_context():
+            self.buffer.toggle(self.user_id, first)
+            self.buffer.toggle(self.user_id, second)
+            Message.query.filter_by(id=first).delete()
+            db.session.commit()
+
+            self.assertEqual(self.buffer.flush(), 1)
+            self.assertEqual(Likes.query.count(), 0)
+            self.assertEqual(User.query.get(self.user_id).likes_count, 0)
+            self.assertEqual(Message.query.get(second).like_count, 0)
+
+    def test_failed_flush_keeps_toggles(self):
+        """Is a batch that fails to write kept, under newer toggles?"""
+
+        first, second = self.message_ids
+
+        def execute_fails(*args, **kwargs):
+            # unliked in the batch, liked again while it's being written
+            self.buffer.toggle(self.user_id, second)
+            raise RuntimeError("database is down")
+
+        with app.app_context():
+            self.buffer.toggle(self.user_id, first)
+            self.buffer.toggle(self.user_id, second)
+
+            with patch.object(db.session, 'execute', execute_fails):
+                with self.assertRaises(RuntimeError):
+                    self.buffer.flush()
+
+            self.assertEqual(self.buffer.pending_for(self.user_id),
+                             {first: 1})
+
+            self.assertEqual(self.buffer.flush(), 1)
+            self.assertEqual({like.message_id for like in Likes.query},
+                             {first, second})
+
+    def test_read_your_writes(self):
+        """Does the liker see a buffered toggle before it's flushed?"""
+
+        first, second = self.message_ids
+        like_buffer._buffer = self.buffer
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess['curr_user'] = self.user_id
+            client.post(f"/users/add_like/{first}")
+
+        with app.app_context():
+            self.assertEqual(Likes.query.count(), 1)
+
+            views = hydrate_messages([first, second], self.user_id)
+            self.assertEqual([(view.liked, view.like_count)
+                              for view in views], [(True, 1), (True, 1)])
+
+            # other viewers only see it once it's written
+            self.assertFalse(hydrate_messages([first])[0].liked)
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess['curr_user'] = self.user_id
+            client.post(f"/users/add_like/{second}")
+
+            html = client.get(f"/users/{self.user_id}/likes").get_data(as_text=True)
+            self.assertIn("<p>First</p>", html)
+            self.assertNotIn("<p>Second</p>", html)
+            self.assertIn(f'<a href="/users/{self.user_id}/likes">1</a>', html)
+
+            html = client.get(f"/messages/{first}").get_data(as_text=True)
+            self.assertIn('<i class="far fa-thumbs-up"></i> 1</span>', html)
+
+            client.post(f"/users/add_like/{second}")
+
+        with app.app_context():
+
+            self.buffer.flush()
+            like_buffer._buffer = None
+            views = hydrate_messages([first, second], self.user_id)
+            self.assertEqual([(view.liked, view.like_count)
+                              for view in views], [(True, 1), (True, 1)])
@@ -6,9 +6,10 @@
 
 
 import os
+from datetime import timedelta
 from unittest import TestCase
 
-from models import db, User, Message, Follows, datetime
+from models import db, User, Message, Follows, Likes, datetime
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -171,3 +172,59 @@ class UserModelTestCase(TestCase):
                 db.session.rollback()
             finally:
                 self.assertEqual(Message.query.count(), 0)
+
+    def test_toggle_like(self):
+        """Does Likes.toggle like, then unlike, and keep both like counts in step?"""
+
+        with app.app_context():
+            u = User(
+                email="test@test.com",
+                username="testuser",
+                password="HASHED_PASSWORD"
+            )
+
+            db.session.add(u)
+            db.session.commit()
+
+            msg = Message(text = "Like me", user_id = u.id)
+            db.session.add(msg)
+            db.session.commit()
+
+            self.assertEqual(Likes.toggle(u.id, msg.id), 1)
+            db.session.commit()
+            self.assertEqual(Likes.query.count(), 1)
+            self.assertEqual(u.likes_count, 1)
+            self.assertEqual(msg.like_count, 1)
+
+            self.assertEqual(Likes.toggle(u.id, msg.id), -1)
+            db.session.commit()
+            self.assertEqual(Likes.query.count(), 0)
+            self.assertEqual(u.likes_count, 0)
+            self.assertEqual(msg.like_count, 0)
+
+            self.assertEqual(Likes.toggle(u.id, msg.id + 1000), 0)
+
+    def test_like_timestamp_is_utc(self):
+        """Is a like toggled in SQL stamped in UTC, like ORM rows?"""
+
+        with app.app_context():
+            u = User(
+                email="test@test.com",
+                username="testuser",
+                password="HASHED_PASSWORD"
+            )
+
+            db.session.add(u)
+            db.session.commit()
+
+            msg = Message(text = "Like me", user_id = u.id)
+            db.session.add(msg)
+            db.session.commit()
+
+            db.session.execute(db.text("SET LOCAL TIME ZONE 'Pacific/Kiritimati'"))
+            Likes.toggle(u.id, msg.id)
+            like = Likes.query.one()
+            db.session.commit()
+
+            self.assertLess(abs(like.timestamp - datetime.utcnow()),
+                            timedelta(minutes=5))
@@ -0,0 +1,199 @@
+"""Schema migration tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_migrations.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Likes
+from migrations import (likes_migrated, migrate_likes, CREATE_LIKES_NEW,
+                        COPY_LIKES)
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+with app.app_context():
+    db.create_all()
+
+
+class LikesMigrationTestCase(TestCase):
+    """Test rebuilding likes around a (user_id, message_id) key."""
+
+    def setUp(self):
+        """Replace likes with the old surrogate-id table, with data."""
+
+        with app.app_context():
+            User.query.delete()
+
+            users = [User.signup(username=f"user{i}",
+                                 email=f"user{i}@test.com",
+                                 password="password",
+                                 image_url=None)
+                     for i in range(2)]
+            db.session.flush()
+            msgs = [Message(text=f"Message {i}", user_id=users[0].id)
+                    for i in range(2)]
+            db.session.add_all(msgs)
+            db.session.flush()
+
+            self.user_ids = [user.id for user in users]
+            self.msg_ids = [msg.id for msg in msgs]
+
+            db.session.execute(db.text("DROP TABLE likes"))
+            db.session.execute(db.text("""
+                CREATE TABLE likes (
+                    id serial PRIMARY KEY,
+                    user_id integer REFERENCES users ON DELETE CASCADE,
+                    message_id integer REFERENCES messages ON DELETE CASCADE
+                )
+            """))
+
+            first, second = self.user_ids
+            rows = [(first, self.msg_ids[0]), (second, self.msg_ids[0]),
+                    (second, self.msg_ids[0]), (second, self.msg_ids[1]),
+                    (first, None)]
+            for user_id, message_id in rows:
+                db.session.execute(
+                    db.text("INSERT INTO likes (user_id, message_id) "
+                            "VALUES (:user_id, :message_id)"),
+                    {'user_id': user_id, 'message_id': message_id})
+            db.session.commit()
+
+    def tearDown(self):
+        """Leave likes in the shape create_all makes."""
+
+        with app.app_context():
+            if not likes_migrated():
+                db.session.execute(db.text("DROP TABLE likes"))
+                db.session.commit()
+                db.create_all()
+
+    def test_migrate_likes(self):
+        """Are likes copied in batches, deduplicated and re-keyed?"""
+
+        first, second = self.user_ids
+
+        with app.app_context():
+            self.assertFalse(likes_migrated())
+            self.assertTrue(migrate_likes(batch_size=2))
+            self.assertTrue(likes_migrated())
+
+            self.assertEqual(
+                sorted((like.user_id, like.message_id)
+                       for like in Likes.query.all()),
+                sorted([(first, self.msg_ids[0]), (second, self.msg_ids[0]),
+                        (second, self.msg_ids[1])]))
+
+            indexes = {name for (name,) in db.session.execute(db.text(
+                "SELECT indexname FROM pg_indexes WHERE tablename = 'likes'"))}
+            self.assertEqual(indexes, {'likes_pkey', 'ix_likes_message_id',
+                                       'ix_likes_user_timestamp'})
+            self.assertEqual(Message.query.get(self.msg_ids[0]).like_count, 2)
+
+            self.assertEqual(Likes.toggle(first, self.msg_ids[1]), 1)
+            db.session.commit()
+
+            self.assertFalse(migrate_likes())
+
+    def test_deletes_while_copying(self):
+        """Are likes deleted after their batch was copied left out?"""
+
+        first, second = self.user_ids
+
+        with app.app_context():
+            # a run interrupted after copying every batch
+            for statement in CREATE_LIKES_NEW:
+                db.session.execute(statement)
+            db.session.execute(COPY_LIKES, {'after': 0, 'upto': 1000})
+            db.session.commit()
+
+            db.session.execute(db.text("""
+                DELETE FROM likes WHERE user_id = :user_id
+                AND message_id = :message_id"""),
+                {'user_id': second, 'message_id': self.msg_ids[1]})
+            # one of a duplicate pair: the other keeps the like
+            db.session.execute(db.text("""
+                DELETE FROM likes WHERE id = (
+                    SELECT min(id) FROM likes WHERE user_id = :user_id
+                    AND message_id = :message_id)"""),
+                {'user_id': second, 'message_id': self.msg_ids[0]})
+            db.session.commit()
+
+            self.assertTrue(migrate_likes())
+            self.assertEqual(
+                sorted((like.user_id, like.message_id)
+                       for like in Likes.query.all()),
+                sorted([(first, self.msg_ids[0]), (second, self.msg_ids[0])]))
+
+            tables = {name for (name,) in db.session.execute(db.text(
+                "SELECT tablename FROM pg_tables "
+                "WHERE schemaname = current_schema()"))}
+            self.assertNotIn('likes_changed', tables)
+
+    def test_inserts_while_copying(self):
+        """Are likes that commit after their id range was copied kept?"""
+
+        first, second = self.user_ids
+
+        with app.app_context():
+            for statement in CREATE_LIKES_NEW:
+                db.session.execute(statement)
+            db.session.commit()
+
+            # id 0 is in no copied range, like an insert that was still
+            # uncommitted when its range was copied
+            db.session.execute(db.text("""
+                INSERT INTO likes (id, user_id, message_id)
+                VALUES (0, :user_id, :message_id)"""),
+                {'user_id': first, 'message_id': self.msg_ids[1]})
+            db.session.commit()
+
+            self.assertTrue(migrate_likes())
+            self.assertEqual(
+                sorted((like.user_id, like.message_id)
+                       for like in Likes.query.all()),
+                sorted([(first, self.msg_ids[0]), (second, self.msg_ids[0]),
+                        (first, self.msg_ids[1]), (second, self.msg_ids[1])]))
+            self.assertEqual(Message.query.get(self.msg_ids[1]).like_count, 2)
+
+    def test_migrate_pre_counter_database(self):
+        """Are columns create_all can't add added before likes are recounted?"""
+
+        with app.app_context():
+            db.session.execute(db.text(
+                "ALTER TABLE messages DROP COLUMN like_count, "
+                "DROP COLUMN fanned_out"))
+            db.session.execute(db.text(
+                "ALTER TABLE users DROP COLUMN likes_count"))
+            db.session.execute(db.text(
+                "ALTER TABLE follows DROP COLUMN timestamp"))
+            db.session.commit()
+
+            self.assertTrue(migrate_likes())
+
+            self.assertEqual(Message.query.get(self.msg_ids[0]).like_count, 2)
+            self.assertTrue(Message.query.get(self.msg_ids[1]).fanned_out)
+            self.assertEqual(User.query.get(self.user_ids[0]).likes_count, 0)
+
+            indexes = {name for (name,) in db.session.execute(db.text(
+                "SELECT indexname FROM pg_indexes "
+                "WHERE tablename IN ('messages', 'follows')"))}
+            self.assertLessEqual({'ix_messages_pulled_user_timestamp_id',
+                                  'ix_follows_following_timestamp',
+                                  'ix_follows_followed_timestamp'}, indexes)
@@ -0,0 +1,145 @@
+"""Follower intersection tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_mutuals.py
+
+
+import os
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+import follow_graph
+from follow_graph import intersect_sorted, reset_follow_graph
+from models import db, User, Follows
+from mutuals import mutual_followers, followers_you_follow
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+with app.app_context():
+    db.create_all()
+
+
+class MutualsTestCase(TestCase):
+    """Test mutual followers and followers you follow."""
+
+    def setUp(self):
+        """Create a viewer, a profile and four accounts between them."""
+
+        reset_follow_graph()
+
+        with app.app_context():
+            User.query.delete()
+
+            self.client = app.test_client()
+
+            users = [User.signup(username=f"user{i}",
+                                 email=f"user{i}@test.com",
+                                 password="password",
+                                 image_url=None)
+                     for i in range(6)]
+            db.session.commit()
+            self.ids = [user.id for user in users]
+
+            viewer, profile, a, b, c, d = self.ids
+            db.session.add_all([
+                Follows(user_following_id=follower,
+                        user_being_followed_id=followed)
+                for follower, followed in [
+                    (viewer, a), (viewer, b), (viewer, d),
+                    (a, profile), (b, profile), (c, profile),
+                    (a, viewer), (c, viewer),
+                ]])
+            db.session.commit()
+
+    def tearDown(self):
+        reset_follow_graph()
+
+    def test_intersect_sorted(self):
+        """Does the sorted intersection find common ids and honor limit?"""
+
+        self.assertEqual(intersect_sorted([1, 3, 5, 7], [2, 3, 4, 7, 9]),
+                         [3, 7])
+        self.assertEqual(intersect_sorted([3, 7], [1, 3, 5, 7], limit=1),
+                         [3])
+        self.assertEqual(intersect_sorted([], [1, 2]), [])
+
+    def test_graph_and_sql_agree(self):
+        """Do the graph and the SQL fallback give the same answers?"""
+
+        viewer, profile, a, b, c, d = self.ids
+
+        with app.app_context():
+            with_sql = (mutual_followers(viewer, profile),
+                        followers_you_follow(viewer, profile, shown=1))
+
+            follow_graph.follow_graph()
+            with_graph = (mutual_followers(viewer, profile),
+                          followers_you_follow(viewer, profile, shown=1))
+
+            for mutuals in (with_sql, with_graph):
+                common, known = mutuals
+                self.assertEqual([u.id for u in common.users], [a, c])
+                self.assertEqual(common.count, 2)
+                self.assertEqual([u.id for u in known.users], [a])
+                self.assertEqual(known.count, 2)
+
+    def test_graph_rebuilt_once_stale(self):
+        """Are follows made elsewhere picked up once the graph is old?"""
+
+        viewer, profile, a, b, c, d = self.ids
+
+        with app.app_context():
+            graph = follow_graph.follow_graph()
+
+            # followed through another process, so never recorded here
+            db.session.add(Follows(user_following_id=d,
+                                   user_being_followed_id=profile))
+            db.session.commit()
+
+            self.assertIs(follow_graph.loaded_follow_graph(), graph)
+            self.assertFalse(graph.is_following(d, profile))
+
+            with patch.dict(app.config, FOLLOW_GRAPH_TTL=0):
+                self.assertIs(follow_graph.loaded_follow_graph(), graph)
+                for _ in range(50):
+                    if follow_graph._graph is not graph:
+                        break
+                    time.sleep(0.1)
+
+            rebuilt = follow_graph.loaded_follow_graph()
+            self.assertIsNot(rebuilt, graph)
+            self.assertTrue(rebuilt.is_following(d, profile))
+            self.assertEqual(followers_you_follow(viewer, profile).count, 3)
+
+    def test_profile_shows_followers_you_follow(self):
+        """Does a profile list who follows it among the accounts you follow?"""
+
+        viewer, profile = self.ids[:2]
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = viewer
+
+            html = c.get(f"/users/{profile}").get_data(as_text=True)
+            self.assertIn('id="known-followers"', html)
+            self.assertIn("@user2", html)
+            self.assertIn("@user3", html)
+
+            html = c.get(f"/users/{viewer}").get_data(as_text=True)
+            self.assertNotIn('id="known-followers"', html)
@@ -0,0 +1,106 @@
+"""Recommendation tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_recommendations.py
+
+
+import os
+from unittest import TestCase
+
+from follow_graph import FollowGraph
+from models import db, User, Follows, Recommendation
+from recommendations import friends_of_friends, refresh_recommendations
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+with app.app_context():
+    db.create_all()
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class RecommendationTestCase(TestCase):
+    """Test friends-of-friends recommendations."""
+
+    def setUp(self):
+        """Create users 0-4, where 0 follows 1 and 2."""
+
+        with app.app_context():
+            User.query.delete()
+
+            self.client = app.test_client()
+
+            users = [User.signup(username=f"user{i}",
+                                 email=f"user{i}@test.com",
+                                 password="password",
+                                 image_url=None)
+                     for i in range(5)]
+            db.session.commit()
+            self.ids = [user.id for user in users]
+
+            me, friend1, friend2, common, other = self.ids
+            db.session.add_all([
+                Follows(user_following_id=follower,
+                        user_being_followed_id=followed)
+                for follower, followed in [
+                    (me, friend1), (me, friend2),
+                    (friend1, common), (friend2, common),
+                    (friend1, other), (friend1, friend2), (friend2, me),
+                ]])
+            db.session.commit()
+
+    def test_friends_of_friends(self):
+        """Are candidates ranked by shared follows, without self or
+        accounts already followed?"""
+
+        pairs = [(0, 1), (0, 2), (1, 2), (1, 3), (1, 4), (2, 0), (2, 3)]
+        graph = FollowGraph.from_pairs(pairs, 5)
+
+        self.assertEqual(friends_of_friends(graph, 0), [(3, 2), (4, 1)])
+        self.assertEqual(friends_of_friends(graph, 0, k=1), [(3, 2)])
+        self.assertEqual(friends_of_friends(graph, 4), [])
+
+    def test_refresh_and_sidebar(self):
+        """Does the batch job store recommendations the home page shows?"""
+
+        me, friend1, friend2, common, other = self.ids
+
+        with app.app_context():
+            self.assertEqual(refresh_recommendations(batch_size=2), 5)
+            stored = (Recommendation.query
+                      .filter_by(user_id=me)
+                      .order_by(Recommendation.score.desc())
+                      .all())
+            self.assertEqual([(r.recommended_id, r.score) for r in stored],
+                             [(common, 2), (other, 1)])
+
+            # followed after the job ran
+            db.session.add(Follows(user_following_id=me,
+                                   user_being_followed_id=other))
+            db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = me
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn("Who to follow", html)
+            self.assertIn("@user3", html)
+            self.assertNotIn('<a href="/users/%d">@user4</a>' % other, html)
@@ -0,0 +1,423 @@
+"""Home timeline tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_timeline.py
+
+
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from unittest import TestCase
+from unittest.mock import patch
+
+import metrics
+from models import db, Message, User, Follows, Likes, TimelineEntry
+from cache import LRUCache
+from counters import reconcile_counts
+from pagination import encode_cursor, decode_cursor
+from timeline import hydrate_messages, timeline_cache
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+with app.app_context():
+    db.create_all()
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class TimelineTestCase(TestCase):
+    """Test the materialized home timeline."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        with app.app_context():
+            User.query.delete()
+            Message.query.delete()
+
+            self.client = app.test_client()
+
+            reader = User.signup(username="reader",
+                                 email="reader@test.com",
+                                 password="readerpass",
+                                 image_url=None)
+            author = User.signup(username="author",
+                                 email="author@test.com",
+                                 password="authorpass",
+                                 image_url=None)
+            db.session.commit()
+
+            self.reader_id = reader.id
+            self.author_id = author.id
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_post_fans_out_to_followers(self):
+        """Does posting a message add it to each follower's timeline?"""
+
+        with app.app_context():
+            db.session.add(Follows(user_being_followed_id=self.author_id,
+                                   user_following_id=self.reader_id))
+            db.session.commit()
+
+        with self.client as c:
+            self.login(c, self.author_id)
+            c.post("/messages/new", data={"text": "Fanned out"})
+
+            entry = TimelineEntry.query.one()
+            self.assertEqual(entry.user_id, self.reader_id)
+            self.assertEqual(entry.author_id, self.author_id)
+
+            self.login(c, self.reader_id)
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn("Fanned out", html)
+
+    def test_follow_backfills_and_unfollow_prunes(self):
+        """Does following backfill the timeline, and unfollowing prune it?"""
+
+        with app.app_context():
+            db.session.add(Message(text="Older post", user_id=self.author_id))
+            db.session.commit()
+
+        with self.client as c:
+            self.login(c, self.reader_id)
+
+            c.post(f"/users/follow/{self.author_id}")
+            self.assertEqual(TimelineEntry.query.count(), 1)
+            self.assertIn("Older post", c.get("/").get_data(as_text=True))
+
+            c.post(f"/users/stop-following/{self.author_id}")
+            self.assertEqual(TimelineEntry.query.count(), 0)
+            self.assertNotIn("Older post", c.get("/").get_data(as_text=True))
+
+    def test_rebuild_timelines_command(self):
+        """Does `flask rebuild-timelines` fill in timelines written
+        without the write path, one batch of followers at a time?"""
+
+        with app.app_context():
+            other = User.signup(username="other", email="other@test.com",
+                                password="otherpass", image_url=None)
+            db.session.flush()
+            db.session.add_all([
+                Follows(user_being_followed_id=self.author_id,
+                        user_following_id=self.reader_id),
+                Follows(user_being_followed_id=self.author_id,
+                        user_following_id=other.id),
+                Message(text="Before the upgrade", user_id=self.author_id),
+            ])
+            db.session.commit()
+            other_id = other.id
+            TimelineEntry.query.delete()
+            db.session.commit()
+
+        result = app.test_cli_runner().invoke(
+            args=['rebuild-timelines', '--batch-size', '1'])
+        self.assertIn("Rebuilt home timelines for 3 users.", result.output)
+
+        with app.app_context():
+            self.assertEqual(
+                sorted(entry.user_id for entry in TimelineEntry.query),
+                sorted([self.reader_id, other_id]))
+
+        with self.client as c:
+            self.login(c, self.reader_id)
+            self.assertIn("Before the upgrade",
+                          c.get("/").get_data(as_text=True))
+
+    def test_delete_message_removes_entries(self):
+        """Does deleting a message remove it from timelines?"""
+
+        with app.app_context():
+            db.session.add(Follows(user_being_followed_id=self.author_id,
+                                   user_following_id=self.reader_id))
+            db.session.commit()
+
+        with self.client as c:
+            self.login(c, self.author_id)
+            c.post("/messages/new", data={"text": "Short lived"})
+            msg = Message.query.one()
+
+            c.post(f"/messages/{msg.id}/delete")
+            self.assertEqual(TimelineEntry.query.count(), 0)
+
+    def test_celebrity_messages_are_pulled(self):
+        """Are messages from accounts over the threshold pulled, not pushed?"""
+
+        with app.app_context():
+            db.session.add(Follows(user_being_followed_id=self.author_id,
+                                   user_following_id=self.reader_id))
+            db.session.commit()
+            reconcile_counts()
+
+        app.config['TIMELINE_CELEBRITY_THRESHOLD'] = 1
+        metrics.reset()
+
+        try:
+            with self.client as c:
+                self.login(c, self.author_id)
+                c.post("/messages/new", data={"text": "Pulled post"})
+
+                self.assertEqual(TimelineEntry.query.count(), 0)
+                self.assertFalse(Message.query.one().fanned_out)
+
+                self.login(c, self.reader_id)
+                html = c.get("/").get_data(as_text=True)
+                self.assertIn("Pulled post", html)
+
+                stats = c.get("/metrics").json
+                self.assertEqual(stats['counters']['timeline.fanout.skipped'], 1)
+                self.assertEqual(stats['counters']['timeline.merge.pulled'], 1)
+                self.assertEqual(stats['gauges']['timeline.celebrity_threshold'], 1)
+        finally:
+            app.config['TIMELINE_CELEBRITY_THRESHOLD'] = 10000
+
+    def test_cursor_round_trip(self):
+        """Does a cursor decode to the key it was built from?"""
+
+        key = (datetime(2022, 11, 5, 12, 30, 1, 250), 42)
+        self.assertEqual(decode_cursor(encode_cursor(*key)), key)
+        self.assertIsNone(decode_cursor(None))
+        self.assertRaises(ValueError, decode_cursor, "not-a-cursor")
+
+        aware = datetime(2022, 1, 1, tzinfo=timezone.utc)
+        self.assertRaises(ValueError, decode_cursor, encode_cursor(aware, 5))
+
+    def test_profile_pages_by_cursor(self):
+        """Does the profile page walk older messages with `before`?"""
+
+        start = datetime(2022, 1, 1)
+
+        with app.app_context():
+            for i in range(3):
+                db.session.add(Message(text=f"Post number {i}",
+                                       user_id=self.author_id,
+                                       timestamp=start + timedelta(days=i)))
+            db.session.commit()
+
+        with self.client as c, patch('app.PROFILE_PAGE_SIZE', 2):
+            html = c.get(f"/users/{self.author_id}").get_data(as_text=True)
+            self.assertIn("Post number 2", html)
+            self.assertIn("Post number 1", html)
+            self.assertNotIn("Post number 0", html)
+
+            cursor = encode_cursor(start + timedelta(days=1),
+                                   Message.query.filter_by(text="Post number 1")
+                                   .one().id)
+            self.assertIn(f"before={cursor}", html)
+
+            html = (c.get(f"/users/{self.author_id}?before={cursor}")
+                    .get_data(as_text=True))
+            self.assertIn("Post number 0", html)
+            self.assertNotIn("Post number 1", html)
+            self.assertNotIn("Older warbles", html)
+
+            resp = c.get(f"/users/{self.author_id}?before=garbage")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_hydrate_messages(self):
+        """Does hydration return views in order with author and like state?"""
+
+        with app.app_context():
+            first = Message(text="First", user_id=self.author_id)
+            second = Message(text="Second", user_id=self.author_id)
+            db.session.add_all([first, second])
+            db.session.commit()
+            db.session.add(Likes(user_id=self.reader_id, message_id=second.id))
+            db.session.commit()
+
+            views = hydrate_messages([second.id, first.id, 99999],
+                                     self.reader_id)
+
+            self.assertEqual([v.text for v in views], ["Second", "First"])
+            self.assertEqual(views[0].username, "author")
+            self.assertTrue(views[0].liked)
+            self.assertFalse(views[1].liked)
+
+    def test_lru_cache_bounds(self):
+        """Does the LRU evict the least recently used entry and expire by TTL?"""
+
+        lru = LRUCache(maxsize=2, ttl=60)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(lru.get('a'), 1)
+        self.assertEqual((lru.hits, lru.misses), (2, 1))
+
+        expired = LRUCache(maxsize=2, ttl=-1)
+        expired.set('a', 1)
+        self.assertIsNone(expired.get('a'))
+
+    def test_cached_timeline_invalidated_by_post(self):
+        """Is the cached home page reused until a followed user posts?"""
+
+        with app.app_context():
+            db.session.add(Follows(user_being_followed_id=self.author_id,
+                                   user_following_id=self.reader_id))
+            db.session.commit()
+
+        with self.client as c:
+            self.login(c, self.reader_id)
+            c.get("/")
+            hits = timeline_cache.pages.hits
+            c.get("/")
+            self.assertEqual(timeline_cache.pages.hits, hits + 1)
+
+            self.login(c, self.author_id)
+            c.post("/messages/new", data={"text": "Fresh post"})
+
+            self.login(c, self.reader_id)
+            self.assertIn("Fresh post", c.get("/").get_data(as_text=True))
+
+    def test_engine_serves_warm_timelines(self):
+        """Is the home page merged in memory once buffers are warm?"""
+
+        with app.app_context():
+            db.session.add(Follows(user_being_followed_id=self.author_id,
+                                   user_following_id=self.reader_id))
+            db.session.commit()
+
+        metrics.reset()
+
+        with self.client as c:
+            self.login(c, self.reader_id)
+            c.get("/")
+
+            self.login(c, self.author_id)
+            c.post("/messages/new", data={"text": "From the engine"})
+
+            self.login(c, self.reader_id)
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn("From the engine", html)
+
+            counters = metrics.snapshot()['counters']
+            self.assertEqual(counters['timeline.engine.fallbacks'], 1)
+            self.assertEqual(counters['timeline.engine.hits'], 1)
+
+    def test_timeline_since(self):
+        """Does polling return only messages newer than the cursor?"""
+
+        with app.app_context():
+            db.session.add(Message(text="Seen already", user_id=self.author_id,
+                                   timestamp=datetime(2022, 1, 1)))
+            db.session.commit()
+
+        with self.client as c:
+            self.login(c, self.reader_id)
+            c.post(f"/users/follow/{self.author_id}")
+
+            seen = Message.query.one()
+            cursor = encode_cursor(seen.timestamp, seen.id)
+
+            data = c.get(f"/timeline/since?after={cursor}").json
+            self.assertEqual(data['messages'], [])
+            self.assertEqual(data['cursor'], cursor)
+
+            self.login(c, self.author_id)
+            c.post("/messages/new", data={"text": "Brand new"})
+
+            self.login(c, self.reader_id)
+            data = c.get(f"/timeline/since?after={cursor}").json
+            self.assertEqual([m['text'] for m in data['messages']],
+                             ["Brand new"])
+            self.assertFalse(data['truncated'])
+
+            resp = c.get(f"/timeline/since?after={cursor}&format=html")
+            html = resp.get_data(as_text=True)
+            self.assertIn("Brand new", html)
+            self.assertNotIn("Seen already", html)
+            self.assertEqual(resp.headers['X-Timeline-Truncated'], 'false')
+
+            # polling again from the returned cursor finds nothing new
+            next_cursor = resp.headers['X-Timeline-Cursor']
+            self.assertNotEqual(next_cursor, cursor)
+            resp = c.get(f"/timeline/since?after={next_cursor}&format=html")
+            self.assertNotIn("Brand new", resp.get_data(as_text=True))
+            self.assertEqual(resp.headers['X-Timeline-Cursor'], next_cursor)
+
+            self.assertEqual(c.get("/timeline/since").status_code, 400)
+
+    def test_login_prewarms_home(self):
+        """Does logging in warm the home page cache in the background?"""
+
+        with app.app_context():
+            db.session.add(Follows(user_being_followed_id=self.author_id,
+                                   user_following_id=self.reader_id))
+            db.session.commit()
+            reconcile_counts()
+
+        metrics.reset()
+
+        with self.client as c:
+            c.post("/login", data={"username": "reader",
+                                   "password": "readerpass"})
+
+            for _ in range(50):
+                if metrics.snapshot()['counters'].get('prewarm.done'):
+                    break
+                time.sleep(0.1)
+
+            hits = timeline_cache.pages.hits
+            html = c.get("/").get_data(as_text=True)
+            self.assertEqual(timeline_cache.pages.hits, hits + 1)
+            self.assertIn('<a href="/users/%d/following">1</a>'
+                          % self.reader_id, html)
+
+    def test_bulk_follow(self):
+        """Does a bulk follow add every follow, counter and timeline entry?"""
+
+        with app.app_context():
+            other = User.signup(username="other",
+                                email="other@test.com",
+                                password="otherpass",
+                                image_url=None)
+            db.session.add(other)
+            db.session.flush()
+            db.session.add_all([Message(text="By author", user_id=self.author_id),
+                                Message(text="By other", user_id=other.id)])
+            db.session.commit()
+            other_id = other.id
+
+        with self.client as c:
+            self.login(c, self.reader_id)
+
+            resp = c.post("/users/follow",
+                          json={"user_ids": [self.author_id, other_id,
+                                             self.reader_id, 999999]})
+            self.assertEqual(resp.json["followed"],
+                             sorted([self.author_id, other_id]))
+
+            resp = c.post("/users/follow", json={"user_ids": [other_id]})
+            self.assertEqual(resp.json["followed"], [])
+
+            for bad in (["x"], "123", {"1": 1}, [True], [1.9]):
+                self.assertEqual(c.post("/users/follow",
+                                        json={"user_ids": bad}).status_code,
+                                 400)
+
+            reader = User.query.get(self.reader_id)
+            self.assertEqual(reader.following_count, 2)
+            self.assertEqual(User.query.get(other_id).followers_count, 1)
+            self.assertEqual(TimelineEntry.query
+                             .filter_by(user_id=self.reader_id).count(), 2)
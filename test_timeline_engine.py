@@ -0,0 +1,88 @@
+"""Timeline engine tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timeline_engine.py
+
+
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+
+from timeline_engine import TimelineEngine
+
+START = datetime(2022, 1, 1)
+
+
+def key(minutes, message_id):
+    return START + timedelta(minutes=minutes), message_id
+
+
+class TimelineEngineTestCase(TestCase):
+    """Test merging timelines from per-author buffers."""
+
+    def setUp(self):
+        self.engine = TimelineEngine(capacity=3, max_authors=10)
+
+    def test_merge_is_newest_first(self):
+        """Does merge interleave authors newest first and stop at limit?"""
+
+        self.engine.load(1, [key(1, 1), key(4, 4)], True, 0)
+        self.engine.load(2, [key(2, 2), key(3, 3), key(5, 5)], True, 0)
+
+        self.assertEqual(self.engine.merge([1, 2], 3),
+                         [key(5, 5), key(4, 4), key(3, 3)])
+        self.assertEqual(self.engine.merge([1, 2], 10, before=key(3, 3)),
+                         [key(2, 2), key(1, 1)])
+
+    def test_cold_author_falls_back(self):
+        """Does merge refuse to answer when an author has no buffer?"""
+
+        self.engine.load(1, [key(1, 1)], True, 0)
+
+        self.assertIsNone(self.engine.merge([1, 2], 10))
+        self.assertEqual(self.engine.cold([1, 2]), [2])
+
+    def test_incomplete_buffer_bounds_the_merge(self):
+        """Does merge stop where an author's buffer may be missing messages?"""
+
+        # author 1 has more messages than the buffer holds
+        self.engine.load(1, [key(10, 10), key(11, 11), key(12, 12),
+                             key(9, 9)], True, 0)
+        self.engine.load(2, [key(1, 1), key(13, 13)], True, 0)
+
+        self.assertEqual(self.engine.merge([1, 2], 4),
+                         [key(13, 13), key(12, 12), key(11, 11), key(10, 10)])
+        self.assertIsNone(self.engine.merge([1, 2], 5))
+
+    def test_push_and_remove(self):
+        """Do posts and deletes update warm buffers?"""
+
+        self.engine.load(1, [key(1, 1)], True, 0)
+        self.engine.push(1, key(2, 2))
+        self.assertEqual(self.engine.merge([1], 10), [key(2, 2), key(1, 1)])
+
+        self.engine.remove(1, 2)
+        self.assertEqual(self.engine.merge([1], 10), [key(1, 1)])
+
+    def test_stale_load_is_dropped(self):
+        """Is a load that raced a post discarded?"""
+
+        generation = self.engine.generation(1)
+        self.engine.push(1, key(2, 2))
+        self.engine.load(1, [key(1, 1)], True, generation)
+
+        self.assertEqual(self.engine.cold([1]), [1])
+
+    def test_expired_buffer_is_cold(self):
+        """Is a buffer older than the ttl reloaded instead of trusted?"""
+
+        engine = TimelineEngine(capacity=3, max_authors=10, ttl=60)
+
+        with patch('timeline_engine.time.monotonic', return_value=1000):
+            engine.load(1, [key(1, 1)], True, 0)
+            self.assertEqual(engine.merge([1], 10), [key(1, 1)])
+
+        with patch('timeline_engine.time.monotonic', return_value=1061):
+            self.assertIsNone(engine.merge([1], 10))
+            self.assertEqual(engine.cold([1]), [1])
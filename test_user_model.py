@@ -135,6 +135,30 @@ class UserModelTestCase(TestCase):
             self.assertEqual(user2.is_following(user1), 0)
             self.assertEqual(user1.is_following(user2), 1)
 
+    def test_is_following_skips_collection(self):
+        """Does is_following answer from an id set without loading user.following?"""
+
+        with app.app_context():
+            user1 =  User(
+                email="test1@test.com",
+                username="testuser1",
+                password="HASHED_PASSWORD1"
+            )
+            user2 =  User(
+                email="test2@test.com",
+                username="testuser2",
+                password="HASHED_PASSWORD2"
+            )
+            db.session.add_all([user1, user2])
+            db.session.commit()
+            follow = Follows(user_being_followed_id = user2.id, user_following_id = user1.id)
+            db.session.add(follow)
+            db.session.commit()
+
+            self.assertTrue(user1.is_following(user2))
+            self.assertEqual(user1.following_ids(), {user2.id})
+            self.assertNotIn('following', user1.__dict__)
+
     def test_user_signup(self):
         """Does User.signup successfully create a new user given valid credentials?"""
 
@@ -222,4 +246,70 @@ class UserModelTestCase(TestCase):
             )
             db.session.add(user1)
             db.session.commit()
-            self.assertFalse(User.authenticate("testuser1", "gea42qgb"))
\ No newline at end of file
+            self.assertFalse(User.authenticate("testuser1", "gea42qgb"))
+
+    def test_card_stats(self):
+        """Does card_stats report counts and follow state for every user at once?"""
+
+        with app.app_context():
+            user1 =  User(
+                email="test1@test.com",
+                username="testuser1",
+                password="HASHED_PASSWORD1"
+            )
+            user2 =  User(
+                email="test2@test.com",
+                username="testuser2",
+                password="HASHED_PASSWORD2",
+                followers_count=1
+            )
+            db.session.add_all([user1, user2])
+            db.session.commit()
+            follow = Follows(user_being_followed_id = user2.id, user_following_id = user1.id)
+            db.session.add(follow)
+            db.session.commit()
+
+            stats = User.card_stats([user1.id, user2.id], user1.id)
+            self.assertTrue(stats[user2.id].followed)
+            self.assertFalse(stats[user2.id].follows_viewer)
+            self.assertEqual(stats[user2.id].followers, 1)
+            self.assertFalse(stats[user1.id].followed)
+
+            stats = User.card_stats([user1.id], user2.id)
+            self.assertTrue(stats[user1.id].follows_viewer)
+
+            stats = User.card_stats([user2.id])
+            self.assertFalse(stats[user2.id].followed)
+
+    def test_follow_and_unfollow(self):
+        """Are follow and unfollow idempotent and do they keep the counters right?"""
+
+        with app.app_context():
+            user1 =  User(
+                email="test1@test.com",
+                username="testuser1",
+                password="HASHED_PASSWORD1"
+            )
+            user2 =  User(
+                email="test2@test.com",
+                username="testuser2",
+                password="HASHED_PASSWORD2"
+            )
+            db.session.add_all([user1, user2])
+            db.session.commit()
+
+            self.assertTrue(user1.follow(user2))
+            self.assertFalse(user1.follow(user2))
+            db.session.commit()
+
+            self.assertTrue(user1.is_following(user2))
+            self.assertEqual(user1.following_count, 1)
+            self.assertEqual(user2.followers_count, 1)
+
+            self.assertTrue(user1.unfollow(user2))
+            self.assertFalse(user1.unfollow(user2))
+            db.session.commit()
+
+            self.assertFalse(user1.is_following(user2))
+            self.assertEqual(Follows.query.count(), 0)
+            self.assertEqual(user2.followers_count, 0)
@@ -6,9 +6,11 @@
 
 
 import os
+import re
+from datetime import datetime
 from unittest import TestCase
 
-from models import db, connect_db, Message, User, Follows
+from models import db, connect_db, Message, User, Follows, Likes
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -207,4 +209,138 @@ class UserViewTestCase(TestCase):
 
             self.assertEqual(resp.status_code, 200)
             self.assertNotIn('<p>@testuser</p>', html)
-            self.assertIn('<h4>New to Warbler?</h4>', html)
\ No newline at end of file
+            self.assertIn('<h4>New to Warbler?</h4>', html)
+
+    def test_streamed_page_consumes_flash(self):
+        """Is a flashed message shown once on a streamed list page?"""
+
+        app.config['STREAM_TEMPLATES'] = True
+
+        try:
+            with self.client as c:
+                c.post('login', data = {
+                    'username': 'testuser',
+                    'password': 'testuserpass'
+                })
+
+                resp = c.get('/')
+                self.assertTrue(resp.is_streamed)
+                self.assertIn('Hello, testuser!', resp.get_data(as_text = True))
+
+                resp = c.get('/')
+                self.assertNotIn('Hello, testuser!', resp.get_data(as_text = True))
+        finally:
+            app.config['STREAM_TEMPLATES'] = False
+
+    def test_counters_follow_writes(self):
+        """Do the denormalized counters track follows, messages and likes?"""
+
+        with app.app_context():
+            user2 = User.query.filter_by(username="testuser2").first()
+            user2_id = user2.id
+            msg = Message(text="Count me", user_id=user2_id)
+            db.session.add(msg)
+            db.session.commit()
+            msg_id = msg.id
+
+        with self.client as c:
+            c.post('login', data = {
+                'username': 'testuser',
+                'password': 'testuserpass'
+            })
+            c.post(f'/users/follow/{user2_id}')
+            c.post(f'/users/add_like/{msg_id}')
+
+            with app.app_context():
+                user1 = User.query.filter_by(username="testuser").first()
+                user2 = User.query.get(user2_id)
+                self.assertEqual((user1.following_count, user1.likes_count), (1, 1))
+                self.assertEqual(user2.followers_count, 1)
+
+            c.post(f'/users/add_like/{msg_id}')
+            c.post(f'/users/stop-following/{user2_id}')
+
+            with app.app_context():
+                user1 = User.query.filter_by(username="testuser").first()
+                user2 = User.query.get(user2_id)
+                self.assertEqual((user1.following_count, user1.likes_count), (0, 0))
+                self.assertEqual(user2.followers_count, 0)
+
+    def test_following_page_is_paginated(self):
+        """Does the following page show newest follows first, a page at a time?"""
+
+        with app.app_context():
+            user1 = User.query.filter_by(username="testuser").first()
+            user2 = User.query.filter_by(username="testuser2").first()
+            user3 = User.signup(username="testuser3",
+                                email="test3@test.com",
+                                password="testuser3pass",
+                                image_url=None)
+            user4 = User.signup(username="testuser4",
+                                email="test4@test.com",
+                                password="testuser4pass",
+                                image_url=None)
+            db.session.flush()
+            db.session.add_all([
+                Follows(user_being_followed_id = user4.id, user_following_id = user1.id,
+                        timestamp = datetime(2021, 12, 31)),
+                Follows(user_being_followed_id = user2.id, user_following_id = user1.id,
+                        timestamp = datetime(2022, 1, 1)),
+                Follows(user_being_followed_id = user3.id, user_following_id = user1.id,
+                        timestamp = datetime(2022, 1, 2)),
+            ])
+            db.session.commit()
+            user1_id = user1.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user1_id
+
+            html = c.get(f'/users/{user1_id}/following?limit=1').get_data(as_text = True)
+            self.assertIn('<p>@testuser3</p>', html)
+            self.assertNotIn('<p>@testuser2</p>', html)
+
+            more = re.search(r'href="(/users/\d+/following\?[^"]+)"', html).group(1)
+            html = c.get(more).get_data(as_text = True)
+            self.assertIn('<p>@testuser2</p>', html)
+            self.assertNotIn('<p>@testuser4</p>', html)
+
+            resp = c.get(f'/users/{user1_id}/following?limit=lots')
+            self.assertEqual(resp.status_code, 400)
+
+    def test_likes_page_is_paginated(self):
+        """Does the likes page show newest likes first, a page at a time?"""
+
+        with app.app_context():
+            user1 = User.query.filter_by(username="testuser").first()
+            user2 = User.query.filter_by(username="testuser2").first()
+            oldest = Message(text = "Liked before", user_id = user2.id)
+            older = Message(text = "Liked first", user_id = user2.id)
+            newer = Message(text = "Liked second", user_id = user2.id)
+            db.session.add_all([oldest, older, newer])
+            db.session.flush()
+            db.session.add_all([
+                Likes(user_id = user1.id, message_id = oldest.id,
+                      timestamp = datetime(2021, 12, 31)),
+                Likes(user_id = user1.id, message_id = older.id,
+                      timestamp = datetime(2022, 1, 1)),
+                Likes(user_id = user1.id, message_id = newer.id,
+                      timestamp = datetime(2022, 1, 2)),
+            ])
+            db.session.commit()
+            user1_id = user1.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user1_id
+
+            html = c.get(f'/users/{user1_id}/likes?limit=1').get_data(as_text = True)
+            self.assertIn('<p>Liked second</p>', html)
+            self.assertIn('@testuser2</a>', html)
+            self.assertNotIn('<p>Liked first</p>', html)
+
+            more = re.search(r'href="(/users/\d+/likes\?[^"]+)"', html).group(1)
+            html = c.get(more).get_data(as_text = True)
+            self.assertIn('<p>Liked first</p>', html)
+            self.assertNotIn('<p>Liked second</p>', html)
+            self.assertNotIn('<p>Liked before</p>', html)
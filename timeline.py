@@ -0,0 +1,668 @@
+"""Materialized home timelines for Warbler.
+
+Each user's home timeline is stored in `timeline_entries`: one row per
+message from someone they follow. Rows are pushed when a message is
+posted, backfilled when a follow starts and pruned when it stops, so
+reading the home page never has to look at the follow graph.
+
+Authors with at least TIMELINE_CELEBRITY_THRESHOLD followers are not
+pushed; their messages are flagged `fanned_out=False` and pulled from
+`messages` when a timeline is read, then merged with the pushed entries.
+
+Rendered pages are kept in `timeline_cache`, and when every followed
+author's recent messages are buffered in `timeline_engine` a page is
+merged in memory without touching the database. The write path queues
+cache invalidations and engine updates on the database session; they
+are applied once the transaction commits. `flask rebuild-timelines`
+refills `timeline_entries` from scratch, e.g. after upgrading a database
+that already had messages.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+from collections import namedtuple
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql import insert
+
+import metrics
+from cache import LRUCache
+from like_buffer import pending_like_changes
+from models import db, Follows, Likes, Message, TimelineEntry, User
+from pagination import encode_cursor, next_cursor
+from timeline_engine import TimelineEngine
+
+HOME_TIMELINE_SIZE = 100
+DEFAULT_CELEBRITY_THRESHOLD = 10000
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_CACHE_TTL = 60
+DEFAULT_ENGINE_BUFFER_SIZE = 200
+DEFAULT_ENGINE_MAX_AUTHORS = 100000
+DEFAULT_ENGINE_TTL = 60
+DEFAULT_REBUILD_BATCH_SIZE = 1000
+
+# most cold author buffers loaded by a single request that falls back to SQL
+ENGINE_WARM_BATCH = 500
+
+# What a timeline template needs to render one message, with no lazy loads.
+MessageView = namedtuple('MessageView', ['id', 'text', 'timestamp', 'user_id',
+                                         'username', 'image_url', 'like_count',
+                                         'liked'])
+
+
+class TimelineCache:
+    """LRU cache of rendered home timeline pages.
+
+    Pages are keyed by viewer, the viewer's timeline version and the page
+    cursor. Invalidating a viewer moves them to a new version, so their
+    old pages (including any being computed concurrently) can never be
+    hit again and simply age out of the LRU.
+
+    Pulled authors are not fanned out, so a page also records the version
+    of each pulled author the viewer follows and is rejected once any of
+    them has posted or deleted.
+    """
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL):
+        self.pages = LRUCache(maxsize, ttl, name='timeline.cache')
+        self._lock = threading.Lock()
+        self._sequence = itertools.count(1)
+        # viewer id -> (version, time bumped); absent means version 0
+        self._viewer_versions = {}
+        self._author_versions = {}
+        # bumped when an author not seen as pulled before starts pulling,
+        # since no cached page can have recorded them
+        self._epoch = 0
+
+    def resize(self, maxsize, ttl):
+        self.pages.resize(maxsize, ttl)
+
+    def version(self, viewer_id):
+        """Current timeline version of `viewer_id`."""
+
+        return self._viewer_versions.get(viewer_id, (0, 0))[0]
+
+    def author_versions(self, author_ids):
+        """Current versions of the pulled authors `author_ids`."""
+
+        with self._lock:
+            return {author_id: self._author_versions.setdefault(author_id, 0)
+                    for author_id in author_ids}
+
+    def get(self, viewer_id, version, before):
+        """Cached page for `viewer_id` at `version` and `before`, or None."""
+
+        entry = self.pages.get((viewer_id, version, before))
+        if entry is None:
+            return None
+
+        page, epoch, author_versions = entry
+        if epoch != self._epoch or any(
+                self._author_versions.get(author_id) != author_version
+                for author_id, author_version in author_versions.items()):
+            self.pages.pop((viewer_id, version, before))
+            return None
+
+        return page
+
+    def put(self, viewer_id, version, before, page, author_versions):
+        """Store `page`, computed while `viewer_id` was at `version`."""
+
+        self.pages.set((viewer_id, version, before),
+                       (page, self._epoch, author_versions))
+
+    def invalidate_viewers(self, viewer_ids):
+        """Give each of `viewer_ids` a new timeline version."""
+
+        now = time.monotonic()
+        with self._lock:
+            for viewer_id in viewer_ids:
+                self._viewer_versions[viewer_id] = (next(self._sequence), now)
+            self._prune_versions(now)
+
+    def invalidate_authors(self, author_ids):
+        """Reject pages that include any of the pulled `author_ids`."""
+
+        with self._lock:
+            for author_id in author_ids:
+                if author_id not in self._author_versions:
+                    self._epoch += 1
+                self._author_versions[author_id] = next(self._sequence)
+
+    def clear(self):
+        with self._lock:
+            self.pages.clear()
+            self._viewer_versions.clear()
+            self._author_versions.clear()
+            self._epoch += 1
+
+    def _prune_versions(self, now):
+        """Forget versions bumped more than a TTL ago.
+
+        Every page cached before such a bump has expired, so the viewer
+        can safely fall back to version 0.
+        """
+
+        if len(self._viewer_versions) <= 2 * self.pages.maxsize:
+            return
+
+        cutoff = now - self.pages.ttl
+        for viewer_id, (_, bumped) in list(self._viewer_versions.items()):
+            if bumped < cutoff:
+                del self._viewer_versions[viewer_id]
+
+
+timeline_cache = TimelineCache()
+timeline_engine = TimelineEngine(DEFAULT_ENGINE_BUFFER_SIZE,
+                                 DEFAULT_ENGINE_MAX_AUTHORS,
+                                 DEFAULT_ENGINE_TTL)
+
+
+def init_timelines(app):
+    """Size the timeline cache and engine from the app's config."""
+
+    timeline_cache.resize(
+        app.config.get('TIMELINE_CACHE_SIZE', DEFAULT_CACHE_SIZE),
+        app.config.get('TIMELINE_CACHE_TTL', DEFAULT_CACHE_TTL))
+    timeline_engine.configure(
+        app.config.get('TIMELINE_ENGINE_BUFFER_SIZE',
+                       DEFAULT_ENGINE_BUFFER_SIZE),
+        app.config.get('TIMELINE_ENGINE_MAX_AUTHORS',
+                       DEFAULT_ENGINE_MAX_AUTHORS),
+        app.config.get('TIMELINE_ENGINE_TTL', DEFAULT_ENGINE_TTL))
+
+
+def after_commit(callback):
+    """Call `callback()` once the current transaction commits.
+
+    Callbacks are dropped if the transaction rolls back instead.
+    """
+
+    db.session.info.setdefault('after_commit', []).append(callback)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _run_after_commit(session):
+    for callback in session.info.pop('after_commit', []):
+        callback()
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _drop_after_commit(session, previous_transaction):
+    session.info.pop('after_commit', None)
+
+
+def invalidate_timeline(viewer_ids=(), pulled_author_ids=()):
+    """Invalidate cached timelines once the current transaction commits."""
+
+    viewer_ids = list(viewer_ids)
+    pulled_author_ids = list(pulled_author_ids)
+
+    def invalidate():
+        timeline_cache.invalidate_viewers(viewer_ids)
+        timeline_cache.invalidate_authors(pulled_author_ids)
+
+    after_commit(invalidate)
+
+
+def celebrity_threshold():
+    """Follower count at which an author is pulled instead of pushed."""
+
+    threshold = current_app.config.get('TIMELINE_CELEBRITY_THRESHOLD',
+                                       DEFAULT_CELEBRITY_THRESHOLD)
+    metrics.gauge('timeline.celebrity_threshold', threshold)
+    return threshold
+
+
+def is_celebrity(user_id):
+    """Does `user_id` have at least the celebrity threshold of followers?"""
+
+    followers = (db.session
+                 .query(User.followers_count)
+                 .filter(User.id == user_id)
+                 .scalar())
+    return (followers or 0) >= celebrity_threshold()
+
+
+def fan_out_message(msg):
+    """Push `msg` into the timeline of every follower of its author.
+
+    Messages from celebrity authors are only flagged, not pushed.
+    `msg` must already be flushed so it has an id.
+    """
+
+    key = message_key(msg)
+    after_commit(lambda: timeline_engine.push(msg.user_id, key))
+
+    if is_celebrity(msg.user_id):
+        msg.fanned_out = False
+        invalidate_timeline(pulled_author_ids=[msg.user_id])
+        metrics.incr('timeline.fanout.skipped')
+        return
+
+    followers = (db.session
+                 .query(Follows.user_following_id,
+                        db.literal(msg.id),
+                        db.literal(msg.user_id),
+                        db.literal(msg.timestamp))
+                 .filter(Follows.user_being_followed_id == msg.user_id))
+
+    result = db.session.execute(
+        insert(TimelineEntry)
+        .from_select(['user_id', 'message_id', 'author_id', 'timestamp'],
+                     followers)
+        .on_conflict_do_nothing()
+        .returning(TimelineEntry.user_id))
+    follower_ids = result.scalars().all()
+
+    invalidate_timeline(follower_ids)
+    metrics.incr('timeline.fanout.pushed')
+    metrics.incr('timeline.fanout.rows', len(follower_ids))
+
+
+def remove_message(msg):
+    """Take `msg` out of every timeline it was pushed to.
+
+    Call before deleting `msg`.
+    """
+
+    author_id, message_id = msg.user_id, msg.id
+    after_commit(lambda: timeline_engine.remove(author_id, message_id))
+
+    if not msg.fanned_out:
+        invalidate_timeline(pulled_author_ids=[msg.user_id])
+        return
+
+    result = db.session.execute(
+        TimelineEntry.__table__
+        .delete()
+        .where(TimelineEntry.message_id == msg.id)
+        .returning(TimelineEntry.user_id))
+    invalidate_timeline(result.scalars().all())
+
+
+def backfill_follow(follower_id, followed_id):
+    """Copy the pushed messages of `followed_id` into the timeline of
+    `follower_id`. Pulled messages are found at read time."""
+
+    backfill_follows(follower_id, [followed_id])
+
+
+def backfill_follows(follower_id, followed_ids):
+    """`backfill_follow` for several newly followed users in one INSERT."""
+
+    messages = (db.session
+                .query(db.literal(follower_id),
+                       Message.id,
+                       Message.user_id,
+                       Message.timestamp)
+                .filter(Message.user_id.in_(followed_ids),
+                        Message.fanned_out))
+
+    db.session.execute(
+        insert(TimelineEntry)
+        .from_select(['user_id', 'message_id', 'author_id', 'timestamp'],
+                     messages)
+        .on_conflict_do_nothing())
+    invalidate_timeline([follower_id])
+
+
+def prune_follow(follower_id, followed_id):
+    """Remove the messages of `followed_id` from the timeline of `follower_id`."""
+
+    (TimelineEntry
+     .query
+     .filter(TimelineEntry.user_id == follower_id,
+             TimelineEntry.author_id == followed_id)
+     .delete(synchronize_session=False))
+    invalidate_timeline([follower_id])
+
+
+def rebuild_timelines(first_id=None, last_id=None,
+                      batch_size=DEFAULT_REBUILD_BATCH_SIZE):
+    """Rebuild the timelines of users `first_id`..`last_id` (inclusive)
+    from `follows` and `messages`.
+
+    Used after bulk loads (e.g. seed.py) that bypass the write path, and
+    to fill `timeline_entries` on a database that already had messages.
+    Replaces `batch_size` followers' entries at a time, each batch in its
+    own transaction. Returns the number of users rebuilt.
+    """
+
+    after = 0 if first_id is None else first_id - 1
+    users = 0
+
+    while True:
+        query = db.session.query(User.id).filter(User.id > after)
+        if last_id is not None:
+            query = query.filter(User.id <= last_id)
+        batch = query.order_by(User.id).limit(batch_size).subquery()
+        batch_start, batch_end, count = db.session.query(
+            db.func.min(batch.c.id), db.func.max(batch.c.id),
+            db.func.count()).one()
+        if batch_end is None:
+            break
+
+        in_batch = db.and_(Follows.user_following_id >= batch_start,
+                           Follows.user_following_id <= batch_end)
+        entries = (db.session
+                   .query(Follows.user_following_id,
+                          Message.id,
+                          Message.user_id,
+                          Message.timestamp)
+                   .join(Message,
+                         Message.user_id == Follows.user_being_followed_id)
+                   .filter(in_batch, Message.fanned_out))
+
+        (TimelineEntry.query
+         .filter(TimelineEntry.user_id >= batch_start,
+                 TimelineEntry.user_id <= batch_end)
+         .delete(synchronize_session=False))
+        db.session.execute(
+            insert(TimelineEntry)
+            .from_select(['user_id', 'message_id', 'author_id', 'timestamp'],
+                         entries)
+            .on_conflict_do_nothing())
+        db.session.commit()
+
+        users += count
+        after = batch_end
+
+    timeline_cache.clear()
+    timeline_engine.clear()
+    return users
+
+
+@click.command('rebuild-timelines')
+@click.option('--first-id', type=int, help="Lowest follower id to rebuild.")
+@click.option('--last-id', type=int, help="Highest follower id to rebuild.")
+@click.option('--batch-size', type=int, default=DEFAULT_REBUILD_BATCH_SIZE,
+              show_default=True, help="Followers rebuilt per transaction.")
+@with_appcontext
+def rebuild_timelines_command(first_id, last_id, batch_size):
+    """Refill timeline_entries from follows and messages."""
+
+    users = rebuild_timelines(first_id, last_id, batch_size)
+    click.echo(f"Rebuilt home timelines for {users} users.")
+
+
+def message_key(msg):
+    """Sort key of `msg` in any timeline: newest first, ties by id."""
+
+    return msg.timestamp, msg.id
+
+
+def pushed_keys(user_id, limit, before=None, after=None):
+    """(timestamp, id) keys of the newest `limit` messages pushed into the
+    timeline of `user_id`, optionally only those older than `before`
+    and/or newer than `after`.
+
+    Reads only the timeline index, never the messages themselves.
+    """
+
+    query = (db.session
+             .query(TimelineEntry.timestamp, TimelineEntry.message_id)
+             .filter(TimelineEntry.user_id == user_id))
+
+    if before:
+        query = query.filter(
+            db.tuple_(TimelineEntry.timestamp, TimelineEntry.message_id)
+            < db.tuple_(*before))
+
+    if after:
+        query = query.filter(
+            db.tuple_(TimelineEntry.timestamp, TimelineEntry.message_id)
+            > db.tuple_(*after))
+
+    rows = (query
+            .order_by(TimelineEntry.timestamp.desc(),
+                      TimelineEntry.message_id.desc())
+            .limit(limit)
+            .all())
+    return [tuple(row) for row in rows]
+
+
+def pulled_keys(user_id, limit, before=None, after=None):
+    """(timestamp, id) keys of the newest `limit` un-pushed messages from
+    accounts `user_id` follows, optionally only those older than `before`
+    and/or newer than `after`.
+
+    Reads at most `limit` messages per followed account, each a short
+    scan of the partial index on un-pushed messages, then merges those.
+    """
+
+    newest = (db.session
+              .query(Message.timestamp, Message.id)
+              .filter(Message.user_id == Follows.user_being_followed_id,
+                      ~Message.fanned_out))
+
+    if before:
+        newest = newest.filter(
+            db.tuple_(Message.timestamp, Message.id) < db.tuple_(*before))
+
+    if after:
+        newest = newest.filter(
+            db.tuple_(Message.timestamp, Message.id) > db.tuple_(*after))
+
+    newest = (newest
+              .order_by(Message.timestamp.desc(), Message.id.desc())
+              .limit(limit)
+              .subquery()
+              .lateral())
+
+    rows = (db.session
+            .query(newest.c.timestamp, newest.c.id)
+            .select_from(Follows)
+            .join(newest, db.true())
+            .filter(Follows.user_following_id == user_id)
+            .order_by(newest.c.timestamp.desc(), newest.c.id.desc())
+            .limit(limit)
+            .all())
+    return [tuple(row) for row in rows]
+
+
+def followed_ids(user_id):
+    """Ids of the accounts `user_id` follows."""
+
+    return [followed_id for (followed_id,) in
+            db.session
+            .query(Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == user_id)]
+
+
+def warm_buffers(author_ids):
+    """Load the engine buffers of `author_ids` in one query."""
+
+    author_ids = author_ids[:ENGINE_WARM_BATCH]
+    if not author_ids:
+        return
+
+    generations = {author_id: timeline_engine.generation(author_id)
+                   for author_id in author_ids}
+    rows = db.session.execute(
+        db.text("""
+            SELECT a.user_id, m.timestamp, m.id
+            FROM unnest(:author_ids) AS a(user_id)
+            CROSS JOIN LATERAL (
+                SELECT timestamp, id
+                FROM messages
+                WHERE messages.user_id = a.user_id
+                ORDER BY timestamp DESC, id DESC
+                LIMIT :per_author
+            ) AS m"""),
+        {'author_ids': author_ids,
+         'per_author': timeline_engine.capacity + 1})
+
+    keys = {author_id: [] for author_id in author_ids}
+    for author_id, timestamp, message_id in rows:
+        keys[author_id].append((timestamp, message_id))
+
+    for author_id, author_keys in keys.items():
+        timeline_engine.load(author_id, author_keys,
+                             len(author_keys) <= timeline_engine.capacity,
+                             generations[author_id])
+    metrics.incr('timeline.engine.warmed', len(author_ids))
+
+
+def engine_timeline(user_id, limit, before=None, after=None):
+    """Merge the timeline of `user_id` from the engine's buffers.
+
+    Returns None when the engine cannot answer, after warming the
+    buffers it was missing so later requests can be served.
+    """
+
+    following = followed_ids(user_id)
+    keys = timeline_engine.merge(following, limit, before, after)
+
+    if keys is None:
+        metrics.incr('timeline.engine.fallbacks')
+        warm_buffers(timeline_engine.cold(following))
+    else:
+        metrics.incr('timeline.engine.hits')
+
+    return keys
+
+
+def home_timeline(user_id, limit=HOME_TIMELINE_SIZE, before=None, after=None):
+    """Return (timestamp, id) keys of the newest `limit` messages in the home
+    timeline of `user_id` that are older than the key `before` and newer
+    than the key `after`, where given.
+
+    Served by `timeline_engine` when its buffers are warm; otherwise merges
+    the pushed timeline with messages pulled from celebrity authors. Pass
+    the ids to `hydrate_messages` to render them.
+    """
+
+    if current_app.config.get('TIMELINE_ENGINE_ENABLED', True):
+        keys = engine_timeline(user_id, limit, before, after)
+        if keys is not None:
+            return keys
+
+    pushed = pushed_keys(user_id, limit, before, after)
+    pulled = pulled_keys(user_id, limit, before, after)
+
+    keys = list(heapq.merge(pushed, pulled, reverse=True))[:limit]
+
+    pulled_set = set(pulled)
+    n_pulled = sum(1 for key in keys if key in pulled_set)
+    metrics.incr('timeline.reads')
+    metrics.incr('timeline.merge.pushed', len(keys) - n_pulled)
+    metrics.incr('timeline.merge.pulled', n_pulled)
+
+    return keys
+
+
+def timeline_since(user_id, after, limit=HOME_TIMELINE_SIZE):
+    """Messages in the home timeline of `user_id` newer than the key `after`.
+
+    Returns (messages, cursor, truncated): up to `limit` of the newest new
+    messages, newest first; the cursor to poll with next; and whether
+    more than `limit` arrived, in which case the client should reload.
+    """
+
+    keys = home_timeline(user_id, limit + 1, after=after)
+    truncated = len(keys) > limit
+    keys = keys[:limit]
+
+    cursor = encode_cursor(*(keys[0] if keys else after))
+    messages = hydrate_messages([id for _, id in keys], user_id)
+    metrics.incr('timeline.since.polls')
+    metrics.incr('timeline.since.messages', len(messages))
+    return messages, cursor, truncated
+
+
+def followed_pulled_authors(user_id):
+    """Ids of accounts `user_id` follows that have pulled messages."""
+
+    has_pulled = (db.session
+                  .query(Message.id)
+                  .filter(Message.user_id == Follows.user_being_followed_id,
+                          ~Message.fanned_out)
+                  .exists())
+
+    return [author_id for (author_id,) in
+            db.session
+            .query(Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == user_id, has_pulled)]
+
+
+def home_page(user_id, before=None, limit=HOME_TIMELINE_SIZE):
+    """Return (messages, next_cursor) for a page of the home timeline of
+    `user_id`, served from `timeline_cache` when possible."""
+
+    version = timeline_cache.version(user_id)
+    page = timeline_cache.get(user_id, version, before)
+    if page is not None:
+        return page
+
+    author_versions = timeline_cache.author_versions(
+        followed_pulled_authors(user_id))
+    keys = home_timeline(user_id, limit, before)
+    page = (hydrate_messages([id for _, id in keys], user_id),
+            next_cursor(keys, limit))
+
+    timeline_cache.put(user_id, version, before, page, author_versions)
+    return page
+
+
+def hydrate_messages(message_ids, viewer_id=None):
+    """Return a MessageView for each of `message_ids`, in the same order.
+
+    Loads the messages with their authors in one query and the viewer's
+    likes among them in a second, so rendering a timeline costs two
+    queries however long it is. Ids of messages that no longer exist are
+    skipped.
+    """
+
+    if not message_ids:
+        return []
+
+    rows = (db.session
+            .query(Message.id, Message.text, Message.timestamp,
+                   Message.user_id, User.username, User.image_url,
+                   Message.like_count)
+            .join(User, User.id == Message.user_id)
+            .filter(Message.id.in_(message_ids))
+            .all())
+
+    liked = set()
+    pending = {}
+    if viewer_id is not None:
+        liked = {message_id for (message_id,) in
+                 db.session
+                 .query(Likes.message_id)
+                 .filter(Likes.user_id == viewer_id,
+                         Likes.message_id.in_(message_ids))}
+        pending = pending_like_changes(viewer_id)
+
+    by_id = {row.id: MessageView(*row, liked=row.id in liked) for row in rows}
+
+    # the viewer's own buffered toggles, not yet written to `likes`
+    for message_id, change in pending.items():
+        view = by_id.get(message_id)
+        if view is not None:
+            by_id[message_id] = view._replace(
+                liked=change > 0, like_count=view.like_count + change)
+
+    return [by_id[id] for id in message_ids if id in by_id]
+
+
+def user_messages(user_id, limit=HOME_TIMELINE_SIZE, before=None):
+    """Return the newest `limit` messages posted by `user_id` that are older
+    than the (timestamp, id) key `before`, if given."""
+
+    query = Message.query.filter(Message.user_id == user_id)
+
+    if before:
+        query = query.filter(
+            db.tuple_(Message.timestamp, Message.id) < db.tuple_(*before))
+
+    return (query
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(limit)
+            .all())
@@ -0,0 +1,222 @@
+"""In-memory home timeline engine.
+
+Keeps a small ring buffer of the newest (timestamp, message_id) keys for
+each author and builds a viewer's timeline with a heap-based k-way merge
+over the buffers of the authors they follow, stopping after `limit`
+items. Nothing here talks to the database: callers load buffers, feed in
+posts and deletes, and fall back to SQL whenever `merge` returns None.
+
+Posts and deletes only reach the engine of the process that handled
+them, so buffers expire `ttl` seconds after they were loaded and are
+reloaded from the database; other processes see a change within `ttl`.
+"""
+
+import heapq
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def _descending(key):
+    """Heap key that pops the newest (timestamp, id) first."""
+
+    timestamp, message_id = key
+    return -((timestamp - _EPOCH) // _MICROSECOND), -message_id
+
+
+class AuthorBuffer:
+    """The newest `capacity` keys of one author, oldest first.
+
+    `complete` means the buffer holds every message the author has, so
+    running out of it says nothing is missing.
+    """
+
+    __slots__ = ('keys', 'capacity', 'complete', 'expires')
+
+    def __init__(self, keys, capacity, complete, expires=None):
+        self.keys = sorted(keys)[-capacity:]
+        self.capacity = capacity
+        self.complete = complete and len(keys) <= capacity
+        # monotonic time after which the buffer must be reloaded
+        self.expires = expires
+
+    def add(self, key):
+        insort(self.keys, key)
+        if len(self.keys) > self.capacity:
+            del self.keys[0]
+            self.complete = False
+
+    def remove(self, message_id):
+        """Drop `message_id`. Returns False if the buffer can no longer
+        vouch for the author's newest messages."""
+
+        for i, (_, buffered_id) in enumerate(self.keys):
+            if buffered_id == message_id:
+                del self.keys[i]
+                # the message that would slide into the buffer is unknown
+                return self.complete
+        return True
+
+    def older_than(self, before):
+        """Index one past the newest key older than `before`."""
+
+        if before is None:
+            return len(self.keys)
+        return bisect_left(self.keys, before)
+
+
+class TimelineEngine:
+    """Per-author ring buffers plus a k-way merge over them.
+
+    At most `max_authors` buffers are kept; the least recently used are
+    dropped and become cold again, as does any buffer loaded more than
+    `ttl` seconds ago (None: never).
+    """
+
+    def __init__(self, capacity=200, max_authors=100000, ttl=None):
+        self.capacity = capacity
+        self.max_authors = max_authors
+        self.ttl = ttl
+        self._buffers = OrderedDict()
+        # bumped on every post/delete so a load that raced one is discarded
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buffers)
+
+    def configure(self, capacity, max_authors, ttl=None):
+        with self._lock:
+            self.capacity = capacity
+            self.max_authors = max_authors
+            self.ttl = ttl
+            self._buffers.clear()
+
+    def clear(self):
+        with self._lock:
+            self._buffers.clear()
+            self._generations.clear()
+
+    def generation(self, author_id):
+        """Token to pass to `load` for a load started now."""
+
+        return self._generations.get(author_id, 0)
+
+    def cold(self, author_ids):
+        """Those of `author_ids` that have no live buffer."""
+
+        now = time.monotonic()
+        return [author_id for author_id in author_ids
+                if self._live(author_id, now) is None]
+
+    def _live(self, author_id, now):
+        buffer = self._buffers.get(author_id)
+        if buffer is None or (buffer.expires is not None
+                              and buffer.expires < now):
+            return None
+        return buffer
+
+    def load(self, author_id, keys, complete, generation):
+        """Install a buffer of `keys` for `author_id`.
+
+        `complete` says `keys` are all of the author's messages. The load
+        is dropped if the author posted or deleted since `generation`.
+        """
+
+        with self._lock:
+            if self._generations.get(author_id, 0) != generation:
+                return
+
+            expires = (None if self.ttl is None
+                       else time.monotonic() + self.ttl)
+            self._buffers[author_id] = AuthorBuffer(keys, self.capacity,
+                                                    complete, expires)
+            self._buffers.move_to_end(author_id)
+
+            while len(self._buffers) > self.max_authors:
+                self._buffers.popitem(last=False)
+
+    def push(self, author_id, key):
+        """Record a new message by `author_id`."""
+
+        with self._lock:
+            self._generations[author_id] = self.generation(author_id) + 1
+            buffer = self._buffers.get(author_id)
+            if buffer is not None:
+                buffer.add(key)
+
+    def remove(self, author_id, message_id):
+        """Record that `message_id` by `author_id` was deleted."""
+
+        with self._lock:
+            self._generations[author_id] = self.generation(author_id) + 1
+            buffer = self._buffers.get(author_id)
+            if buffer is not None and not buffer.remove(message_id):
+                del self._buffers[author_id]
+
+    def merge(self, author_ids, limit, before=None, after=None):
+        """Newest `limit` keys across `author_ids` older than `before` and
+        newer than `after`, where given.
+
+        Returns None if any author is cold or expired, or if an
+        incomplete buffer ran out before `limit` keys could be proven to
+        be the newest.
+        """
+
+        with self._lock:
+            now = time.monotonic()
+            buffers = []
+            for author_id in author_ids:
+                buffer = self._live(author_id, now)
+                if buffer is None:
+                    return None
+                self._buffers.move_to_end(author_id)
+                buffers.append(buffer)
+
+            heap = []
+            # anything older than `floor` may be preceded by messages that
+            # fell out of some author's buffer
+            floor = None
+
+            for i, buffer in enumerate(buffers):
+                end = buffer.older_than(before)
+                if end:
+                    key = buffer.keys[end - 1]
+                    heap.append((_descending(key), i, end - 1))
+                elif not buffer.complete and buffer.keys:
+                    floor = max(floor or buffer.keys[0], buffer.keys[0])
+                elif not buffer.complete:
+                    return None
+
+            heapq.heapify(heap)
+            keys = []
+
+            while heap and len(keys) < limit:
+                _, i, pos = heapq.heappop(heap)
+                buffer = buffers[i]
+                key = buffer.keys[pos]
+
+                if after is not None and key <= after:
+                    break
+                if floor is not None and key < floor:
+                    return None
+                keys.append(key)
+
+                if pos:
+                    next_key = buffer.keys[pos - 1]
+                    heapq.heappush(heap, (_descending(next_key), i, pos - 1))
+                elif not buffer.complete:
+                    floor = max(floor or key, key)
+
+            # a short page is only final if nothing can be missing above
+            # `after`
+            if (len(keys) < limit and floor is not None
+                    and (after is None or floor > after)):
+                return None
+
+            return keys